@@ -17,7 +17,10 @@ from ckanapi.errors import (
     )
 from ckanapi.localckan import LocalCKAN
 from ckanapi.remoteckan import RemoteCKAN
+from ckanapi.asyncremoteckan import AsyncRemoteCKAN
 from ckanapi.testappckan import TestAppCKAN
+from ckanapi.common import RetryPolicy
+from ckanapi.cache import MemoryCache, SQLiteCache
 
 
 
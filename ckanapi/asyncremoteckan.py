@@ -0,0 +1,141 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from ckanapi.remoteckan import RemoteCKAN
+from ckanapi.common import _Pager
+
+# maximum number of requests in flight for sites in MY_SITES
+DEFAULT_CONCURRENCY = 100
+
+
+class AsyncRemoteCKAN(RemoteCKAN):
+    """
+    An asyncio interface to the CKAN API actions on a remote CKAN instance.
+
+    call_action and the .action shortcut return coroutines, e.g.::
+
+        async with AsyncRemoteCKAN('http://demo.ckan.org') as demo:
+            pkgs = await asyncio.gather(*(
+                demo.action.package_show(id=n) for n in names))
+
+    Requests share a single keep-alive connection pool and at most
+    concurrency of them are in flight at the same time.
+
+    :param address: the web address of the CKAN instance, e.g.
+                    'http://demo.ckan.org', stored as self.address
+    :param apikey: the API key to pass as an 'X-CKAN-API-Key' header
+                    when actions are called, stored as self.apikey
+    :param user_agent: the User-agent to report when making requests
+    :param get_only: only use GET requests (default: False)
+    :param session: session to use (default: None)
+    :param retry: RetryPolicy for failed requests (default: None)
+    :param rate_limit: maximum requests per second (default: None)
+    :param cache: ActionCache for read-only actions (default: None)
+    :param concurrency: maximum number of requests in flight, limited to
+                        parallel_limit for sites not in MY_SITES
+                        (default: DEFAULT_CONCURRENCY)
+
+    Other keyword arguments such as compress and keepalive are passed
+    to RemoteCKAN.
+    """
+    def __init__(self, address, apikey=None, user_agent=None, get_only=False,
+            session=None, retry=None, rate_limit=None, cache=None,
+            concurrency=DEFAULT_CONCURRENCY, **kwargs):
+        super(AsyncRemoteCKAN, self).__init__(address, apikey=apikey,
+            user_agent=user_agent, get_only=get_only, session=session,
+            retry=retry, rate_limit=rate_limit, cache=cache, **kwargs)
+        if hasattr(self, 'parallel_limit'):
+            # add your sites to CKANAPI_MY_SITES instead of removing
+            concurrency = min(concurrency, self.parallel_limit)
+        self.concurrency = concurrency
+        # keep a connection open for each request in flight
+        self.pool_maxsize = max(self.pool_maxsize, concurrency)
+        self._semaphore = None
+        self._executor = None
+
+    async def call_action(self, action, data_dict=None, context=None,
+            apikey=None, files=None, requests_kwargs=None):
+        """
+        :param action: the action name, e.g. 'package_create'
+        :param data_dict: the dict to pass to the action as JSON,
+                          defaults to {}
+        :param context: always set to None for AsyncRemoteCKAN
+        :param apikey: API key for authentication
+        :param files: None or {field-name: file-to-be-sent, ...}
+        :param requests_kwargs: kwargs for requests get/post calls
+
+        Coroutine returning the same value or raising the same exception
+        as RemoteCKAN.call_action. The blocking request is made on a
+        thread pool shared by all calls on this instance.
+        """
+        if self._semaphore is None:
+            # created here so they are bound to the running event loop
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._executor = ThreadPoolExecutor(self.concurrency)
+        call = partial(RemoteCKAN.call_action, self, action, data_dict,
+            context=context, apikey=apikey, files=files,
+            requests_kwargs=requests_kwargs)
+        async with self._semaphore:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, call)
+
+    async def call_actions(self, calls, apikey=None, requests_kwargs=None):
+        """
+        Coroutine calling many actions concurrently, limited by
+        concurrency.
+
+        :param calls: list of (action name, data_dict) tuples
+        :param apikey: API key for authentication
+        :param requests_kwargs: kwargs for requests get/post calls
+
+        Returns a list with the result of each call in the same order,
+        or the exception raised by a call in place of its result.
+        """
+        return await asyncio.gather(*(
+            self.call_action(action, data_dict, apikey=apikey,
+                requests_kwargs=requests_kwargs)
+            for action, data_dict in calls), return_exceptions=True)
+
+    async def iter_action(self, action, data_dict=None, requests_kwargs=None,
+            keyset=False):
+        """
+        Async generator yielding every record from a paginated list or
+        search action, requesting the next page while the current page
+        is consumed. See ckanapi.common.iter_action.
+        """
+        pager = _Pager(action, data_dict, keyset)
+        call = pager.next_call()
+        rows = pager.rows(await self.call_action(call[0], call[1],
+            requests_kwargs=requests_kwargs))
+        task = None
+        try:
+            while True:
+                call = pager.next_call()
+                if call:
+                    task = asyncio.ensure_future(self.call_action(
+                        call[0], call[1], requests_kwargs=requests_kwargs))
+                for r in rows:
+                    yield r
+                if not call:
+                    return
+                rows = pager.rows(await task)
+                task = None
+        finally:
+            if task:
+                task.cancel()
+
+    def close(self):
+        """Close session and thread pool"""
+        super(AsyncRemoteCKAN, self).close()
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        # waiting for calls still running would block the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
@@ -0,0 +1,148 @@
+"""
+Response caches for read-only RemoteCKAN actions
+"""
+
+from collections import OrderedDict
+import hashlib
+import sqlite3
+import threading
+import time
+
+from ckanapi import codec
+
+# seconds a cached response is used before it is revalidated
+DEFAULT_TTL = 60
+
+
+class ActionCache(object):
+    """
+    Base class for RemoteCKAN response caches. Responses to read-only
+    actions are stored by action name, data_dict and API key.
+
+    When a response is older than its TTL the request is sent again with
+    If-None-Match/If-Modified-Since headers from the cached response, so
+    a 304 Not Modified reply reuses the cached response.
+
+    :param ttl: seconds to use a cached response without revalidating
+    :param ttls: {action name: seconds} overriding ttl for some actions,
+                 0 to always revalidate
+
+    Subclasses implement get, set and clear.
+    """
+    def __init__(self, ttl=DEFAULT_TTL, ttls=None):
+        self.ttl = ttl
+        self.ttls = dict(ttls or {})
+
+    def ttl_for(self, action):
+        return self.ttls.get(action, self.ttl)
+
+    def key(self, action, data_dict, apikey):
+        """
+        return the cache key for an action call
+        """
+        return hashlib.sha256(codec.dumps(
+            [action, data_dict or {}, apikey], sort_keys=True)).hexdigest()
+
+    def new_entry(self, action, r):
+        """
+        return an entry dict for requests response r to action
+        """
+        return {
+            'status': r.status_code,
+            'text': r.text,
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+            'expires': time.time() + self.ttl_for(action),
+            }
+
+    def get(self, key):
+        """
+        return the entry dict stored for key or None
+        """
+        raise NotImplementedError
+
+    def set(self, key, entry):
+        """
+        store entry dict for key
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        """
+        remove all entries
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryCache(ActionCache):
+    """
+    In-memory least-recently-used response cache
+
+    :param maxsize: maximum number of responses kept
+    """
+    def __init__(self, maxsize=1000, ttl=DEFAULT_TTL, ttls=None):
+        super(MemoryCache, self).__init__(ttl=ttl, ttls=ttls)
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                entry = dict(entry)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = dict(entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteCache(ActionCache):
+    """
+    Response cache stored in an SQLite database file, so it can be
+    shared between processes and reused by later runs
+
+    :param path: database file name, created if it doesn't exist
+    """
+    def __init__(self, path, ttl=DEFAULT_TTL, ttls=None):
+        super(SQLiteCache, self).__init__(ttl=ttl, ttls=ttls)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS responses '
+                '(key TEXT PRIMARY KEY, entry TEXT)')
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT entry FROM responses WHERE key = ?', (key,)
+                ).fetchone()
+        return codec.loads(row[0]) if row else None
+
+    def set(self, key, entry):
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses (key, entry) VALUES (?, ?)',
+                (key, codec.dumps(entry).decode('utf-8')))
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM responses')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
@@ -3,9 +3,9 @@ implementation of the action cli command
 """
 
 import sys
-import json
 from os.path import expanduser
 
+from ckanapi import codec
 from ckanapi.cli.utils import compact_json, pretty_json
 from ckanapi.errors import CLIError
 
@@ -22,11 +22,11 @@ def action(ckan, arguments, stdin=None):
     if arguments['--insecure']:
         requests_kwargs = {'verify': False}
     if arguments['--input-json']:
-        action_args = json.loads(stdin.read().decode('utf-8'))
+        action_args = codec.loads(stdin.read())
     elif arguments['--input']:
         action_args = {}
         with open(expanduser(arguments['--input'])) as in_f:
-            action_args = json.loads(
+            action_args = codec.loads(
                 in_f.read())
     else:
         action_args = {}
@@ -40,7 +40,7 @@ def action(ckan, arguments, stdin=None):
                 action_args[skey] = svalue
             elif len(skey) > len(jkey) < len(fkey):
                 try:
-                    value = json.loads(jvalue)
+                    value = codec.loads(jvalue)
                 except ValueError:
                     raise CLIError("KEY:JSON argument %r has invalid JSON "
                         "value %r" % (jkey, jvalue))
@@ -4,9 +4,10 @@ implementation of batch cli command
 
 import sys
 import gzip
-import json
 from datetime import datetime
+from functools import partial
 
+from ckanapi import codec
 from ckanapi.errors import (NotFound, NotAuthorized, ValidationError,
     SearchIndexError)
 from ckanapi.cli import workers
@@ -61,20 +62,17 @@ def batch_actions(ckan, arguments,
             yield num, line
 
     cmd = _worker_command_line(arguments)
-    processes = int(arguments['--processes'])
-    if hasattr(ckan, 'parallel_limit'):
-        # add your sites to CKANAPI_MY_SITES instead of removing
-        processes = min(processes, ckan.parallel_limit)
+    cmd, processes, pool_kwargs = workers.pool_options(ckan, arguments,
+        cmd, partial(batch_actions_worker, ckan, arguments))
     stats = completion_stats(processes)
-    pool = worker_pool(cmd, processes, line_reader())
+    pool = worker_pool(cmd, processes, line_reader(), **pool_kwargs)
 
     with quiet_int_pipe() as errors:
         for job_ids, finished, result in pool:
             if not result:
                 # child exited with traceback
                 return 1
-            timestamp, action, error, response = json.loads(
-                result.decode('utf-8'))
+            timestamp, action, error, response = codec.loads(result)
 
             if not arguments['--quiet']:
                 stderr.write(('%s %s %s %s %s %s\n' % (
@@ -135,7 +133,7 @@ def batch_actions_worker(ckan, arguments,
 
     for line in iter(stdin.readline, b''):
         try:
-            obj = json.loads(line.decode('utf-8'))
+            obj = codec.loads(line)
         except UnicodeDecodeError as e:
             obj = None
             reply('read', 'UnicodeDecodeError', str(e))
@@ -183,16 +181,20 @@ def _worker_command_line(arguments):
     """
     def a(name):
         "options with values"
-        return [name, arguments[name]] * (arguments[name] is not None)
+        return [name, arguments.get(name)] * (
+            arguments.get(name) is not None)
     def b(name):
         "boolean options"
-        return [name] * bool(arguments[name])
+        return [name] * bool(arguments.get(name))
     return (
         ['ckanapi', 'batch', '--worker']
         + a('--config')
         + a('--ckan-user')
         + a('--remote')
         + a('--apikey')
+        + a('--retries')
+        + a('--compress')
+        + b('--retry-writes')
         + b('--local-files')
         + b('--insecure')
         )
@@ -4,12 +4,13 @@ implementation of delete cli command
 
 import sys
 import gzip
-import json
 from datetime import datetime
+from functools import partial
 from itertools import chain
 import re
 from urllib.parse import urlparse
 
+from ckanapi import codec
 from ckanapi.errors import (NotFound, NotAuthorized, ValidationError,
     SearchIndexError)
 from ckanapi.cli import workers
@@ -69,24 +70,22 @@ def delete_things(ckan, thing, arguments,
             yield num, compact_json(name)
 
     cmd = _worker_command_line(thing, arguments)
-    processes = int(arguments['--processes'])
-    if hasattr(ckan, 'parallel_limit'):
-        # add your sites to CKANAPI_MY_SITES instead of removing
-        processes = min(processes, ckan.parallel_limit)
+    cmd, processes, pool_kwargs = workers.pool_options(ckan, arguments,
+        cmd, partial(delete_things_worker, ckan, thing, arguments))
     stats = completion_stats(processes)
     if not arguments['ID_OR_NAME']:
-        pool = worker_pool(cmd, processes, name_reader())
+        pool = worker_pool(cmd, processes, name_reader(), **pool_kwargs)
     else:
         pool = worker_pool(cmd, processes, enumerate(
-            (compact_json(n) + b'\n' for n in arguments['ID_OR_NAME']), 1))
+            (compact_json(n) + b'\n' for n in arguments['ID_OR_NAME']), 1),
+            **pool_kwargs)
 
     with quiet_int_pipe() as errors:
         for job_ids, finished, result in pool:
             if not result:
                 # child exited with traceback
                 return 1
-            timestamp, error, response = json.loads(
-                result.decode('utf-8'))
+            timestamp, error, response = codec.loads(result)
 
             if not arguments['--quiet']:
                 stderr.write(('%s %s %s %s %s\n' % (
@@ -126,7 +125,7 @@ def extract_ids_or_names(line):
     Returns a list of ids or names found in line
     """
     try:
-        j = json.loads(line)
+        j = codec.loads(line)
     except ValueError:
         return [line.strip()]  # 5
     if isinstance(j, list) and all(
@@ -194,7 +193,7 @@ def delete_things_worker(ckan, thing, arguments,
 
     for line in iter(stdin.readline, b''):
         try:
-            name = json.loads(line.decode('utf-8'))
+            name = codec.loads(line)
         except UnicodeDecodeError as e:
             reply('UnicodeDecodeError', str(e))
             continue
@@ -219,11 +218,17 @@ def _worker_command_line(thing, arguments):
     """
     def a(name):
         "options with values"
-        return [name, arguments[name]] * (arguments[name] is not None)
+        return [name, arguments.get(name)] * (
+            arguments.get(name) is not None)
+    def b(name):
+        "boolean options"
+        return [name] * bool(arguments.get(name))
     return (
         ['ckanapi', 'delete', thing, '--worker']
         + a('--config')
         + a('--ckan-user')
         + a('--remote')
         + a('--apikey')
+        + a('--retries')
+        + b('--retry-writes')
         )
@@ -4,17 +4,27 @@ implementation of dump cli command
 
 import sys
 import gzip
-import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 import os
+import tempfile
 
+from ckanapi import codec
 from ckanapi.errors import (CKANAPIError, NotFound, NotAuthorized, ValidationError,
     SearchIndexError)
 from ckanapi.cli import workers
 from ckanapi.cli.utils import completion_stats, compact_json, \
     quiet_int_pipe
-from ckanapi.datapackage import create_datapackage, \
-    populate_datastore_res_fields
+from ckanapi.cli.search import search_records
+from ckanapi.remoteckan import RemoteCKAN, CALL_ACTIONS_WORKERS
+from ckanapi.datapackage import create_datapackage, DownloadPool, \
+    DownloadStore, DOWNLOAD_WORKERS
+
+# maximum number of jobs started past the oldest unfinished job when
+# writing records in order
+REORDER_WINDOW = 1000
 
 
 def dump_things(ckan, thing, arguments,
@@ -36,6 +46,29 @@ def dump_things(ckan, thing, arguments,
     if arguments['--worker']:
         return dump_things_worker(ckan, thing, arguments)
 
+    if arguments.get('--via-search') and (
+            thing != 'datasets' or not arguments['--all']):
+        stderr.write(b'--via-search may only be used with datasets --all\n')
+        return 1
+
+    state_file = arguments.get('--state-file')
+    watermark = incremental = None
+    if state_file:
+        if thing != 'datasets' or not arguments['--all'] or not (
+                arguments['--output']):
+            stderr.write(b'--state-file may only be used with '
+                b'datasets --all -O JSONL_OUTPUT\n')
+            return 1
+        # datasets modified after this point will be picked up next time
+        watermark = _latest_metadata_modified(ckan, arguments)
+        if os.path.exists(state_file):
+            if os.path.exists(arguments['--output']):
+                with open(state_file, 'rb') as f:
+                    incremental = codec.loads(f.read())
+            else:
+                stderr.write(b'JSONL_OUTPUT not found, '
+                    b'dumping all datasets\n')
+
     log = None
     if arguments['--log']:
         log = open(arguments['--log'], 'ab')
@@ -43,11 +76,16 @@ def dump_things(ckan, thing, arguments,
     jsonl_output = stdout
     if arguments['--datapackages']:  # TODO: do we want to just divert this to devnull?
         jsonl_output = open(os.devnull, 'wb')
-    if arguments['--output']:
+    if incremental:
+        # changed records are merged into --output after they are dumped
+        jsonl_output = tempfile.TemporaryFile()
+    elif arguments['--output']:
         jsonl_output = open(arguments['--output'], 'wb')
-    if arguments['--gzip']:
+    if arguments['--gzip'] and not incremental:
         jsonl_output = gzip.GzipFile(fileobj=jsonl_output)
-    if arguments['--all']:
+    if arguments.get('--via-search') or incremental:
+        names = None
+    elif arguments['--all']:
         params = None
         get_thing_list = {
             'datasets': 'package_list',
@@ -78,13 +116,35 @@ def dump_things(ckan, thing, arguments,
     if arguments['--datapackages']:
         arguments['--datastore-fields'] = True
     cmd = _worker_command_line(thing, arguments)
-    processes = int(arguments['--processes'])
-    if hasattr(ckan, 'parallel_limit'):
-        # add your sites to CKANAPI_MY_SITES instead of removing
-        processes = min(processes, ckan.parallel_limit)
+    cmd, processes, pool_kwargs = workers.pool_options(ckan, arguments,
+        cmd, partial(dump_things_worker, ckan, thing, arguments))
+    unordered = arguments.get('--unordered')
+    if not unordered:
+        # limit records held waiting for a slow earlier record
+        pool_kwargs['window'] = max(REORDER_WINDOW,
+            processes * pool_kwargs.get('pipeline', 1) * 2)
     stats = completion_stats(processes)
-    pool = worker_pool(cmd, processes,
-        enumerate(compact_json(n) + b'\n' for n in names))
+    if 'limiter' in pool_kwargs:
+        # busy workers aren't adjusted when paging through search results
+        processes = pool_kwargs['limiter'].limit
+    if incremental:
+        pool = _search_pool(ckan, arguments, processes,
+            fq='metadata_modified:[%sZ TO *]'
+            % incremental['metadata_modified'][:19])
+    elif arguments.get('--via-search'):
+        pool = _search_pool(ckan, arguments, processes)
+    else:
+        pool = worker_pool(cmd, processes,
+            enumerate(compact_json(n) + b'\n' for n in names),
+            framed=True, **pool_kwargs)
+
+    download_pool = store = None
+    if arguments['--datapackages']:
+        # download resources in the background while records are dumped
+        download_pool = DownloadPool(
+            int(arguments.get('--downloads') or DOWNLOAD_WORKERS))
+        if arguments.get('--resource-store'):
+            store = DownloadStore(arguments['--resource-store'])
 
     results = {}
     expecting_number = 0
@@ -93,7 +153,9 @@ def dump_things(ckan, thing, arguments,
             if not result:
                 # child exited with traceback
                 return 1
-            timestamp, error, record = json.loads(result.decode('utf-8'))
+            # records arrive as the JSON lines to output, only the small
+            # metadata part of the result is decoded here
+            (timestamp, error, name), record = workers.unframe(result)
             results[finished] = record
 
             if not arguments['--quiet']:
@@ -102,7 +164,7 @@ def dump_things(ckan, thing, arguments,
                     job_ids,
                     next(stats),
                     error,
-                    record.get('name', '') if record else '',
+                    name or '',
                     ).encode('utf-8'))
 
             if log:
@@ -110,24 +172,42 @@ def dump_things(ckan, thing, arguments,
                     timestamp,
                     finished,
                     error,
-                    record.get('name', '') if record else None,
+                    name,
                     ]) + b'\n')
 
             datapackages_path = arguments['--datapackages']
             apikey = arguments['--apikey']
-            if datapackages_path:
-                create_datapackage(record, datapackages_path, stderr, apikey)
+            if datapackages_path and record:
+                create_datapackage(codec.loads(record), datapackages_path,
+                    stderr, apikey, download_pool=download_pool,
+                    store=store,
+                    ckan=ckan if arguments.get('--datastore-csv') else None)
+
+            if unordered:
+                record = results.pop(finished)
+                if record:
+                    jsonl_output.write(record + b'\n')
+                continue
 
             # keep the output in the same order as names
             while expecting_number in results:
                 record = results.pop(expecting_number)
                 if record:
-                    # sort keys so we can diff output
-                    jsonl_output.write(compact_json(record,
-                        sort_keys=True) + b'\n')
+                    jsonl_output.write(record + b'\n')
                 expecting_number += 1
+    if download_pool:
+        download_pool.shutdown(wait=not errors)
+    if incremental and not errors:
+        jsonl_output.seek(0)
+        deleted = _merge_changes(jsonl_output, arguments)
     if jsonl_output != stdout:
         jsonl_output.close()
+    if state_file and watermark and not errors:
+        with open(state_file, 'wb') as f:
+            f.write(compact_json({
+                'metadata_modified': watermark,
+                'deleted': deleted if incremental else [],
+                }) + b'\n')
     if 'pipe' in errors:
         return 1
     if 'interrupt' in errors:
@@ -167,15 +247,12 @@ def dump_things_worker(ckan, thing, arguments,
         """
         format messages to be sent back to parent process
         """
-        stdout.write(compact_json([
-            datetime.now().isoformat(),
-            error,
-            record]) + b'\n')
+        stdout.write(_dump_result(error, record))
         stdout.flush()
 
     for line in iter(stdin.readline, b''):
         try:
-            name = json.loads(line.decode('utf-8'))
+            name = codec.loads(line)
         except UnicodeDecodeError as e:
             reply('UnicodeDecodeError')
             continue
@@ -198,14 +275,178 @@ def dump_things_worker(ckan, thing, arguments,
         except NotAuthorized:
             reply('NotAuthorized')
         else:
-            if thing == 'datasets' and arguments['--datastore-fields']:
-                for res in obj.get('resources', []):
-                    populate_datastore_res_fields(ckan, res)
-            if thing == 'datasets' and arguments['--resource-views']:
-                for res in obj.get('resources', []):
-                    populate_res_views(ckan, res)
+            if thing == 'datasets':
+                populate_resources(ckan, obj.get('resources', []),
+                    datastore_fields=arguments['--datastore-fields'],
+                    views=arguments['--resource-views'],
+                    requests_kwargs=requests_kwargs,
+                    # --threads already share the session's connections,
+                    # --max-rps paces jobs, not requests, in worker processes
+                    concurrent=not arguments.get('--threads') and not (
+                        arguments.get('--worker')
+                        and arguments.get('--max-rps')))
             reply(None, obj)
 
+def _search_pool(ckan, arguments, processes=1, fq=None):
+    """
+    replacement for worker_pool used by dump datasets --all --via-search
+
+    pages through package_search results in this process and yields
+    the same (job ids, finished job id, result) tuples as worker_pool,
+    calling package_show only for search results that are incomplete
+
+    processes - number of search results completed at the same time
+                with threads sharing a RemoteCKAN
+    fq - filter query limiting the datasets returned, deleted datasets
+         are included so that they can be removed from incremental dumps
+    """
+    requests_kwargs = None
+    if arguments['--insecure']:
+        requests_kwargs = {'verify': False}
+    params = {
+        'q': '*:*',
+        'sort': 'name asc',  # same order as package_list
+        'include_private': bool(arguments.get('--include-private')),
+        'include_drafts': bool(arguments.get('--include-drafts')),
+        }
+    if arguments.get('--include-deleted') or fq:
+        params['include_deleted'] = True
+    if fq:
+        params['fq'] = fq
+    # LocalCKAN isn't thread-safe
+    threaded = processes > 1 and isinstance(ckan, RemoteCKAN)
+
+    def complete(obj):
+        if fq and obj.get('state') == 'deleted' and not arguments.get(
+                '--include-deleted'):
+            # only the id is needed to remove deleted datasets
+            return _dump_result(None, obj)
+        if _search_result_incomplete(obj):
+            try:
+                obj = ckan.call_action('package_show', {'id': obj['id']},
+                    requests_kwargs=requests_kwargs)
+            except NotFound:
+                return _dump_result('NotFound', None)
+            except NotAuthorized:
+                return _dump_result('NotAuthorized', None)
+        populate_resources(ckan, obj.get('resources', []),
+            datastore_fields=arguments['--datastore-fields'],
+            views=arguments['--resource-views'],
+            requests_kwargs=requests_kwargs,
+            concurrent=not threaded)
+        return _dump_result(None, obj)
+
+    records = enumerate(search_records(ckan, params, requests_kwargs))
+    if not threaded:
+        for num, obj in records:
+            yield [], num, complete(obj)
+        return
+
+    with ThreadPoolExecutor(processes) as executor:
+        # complete a few records ahead of the one being yielded
+        pending = deque()
+        for num, obj in records:
+            pending.append((num, executor.submit(complete, obj)))
+            if len(pending) > processes * 2:
+                num, future = pending.popleft()
+                yield [], num, future.result()
+        while pending:
+            num, future = pending.popleft()
+            yield [], num, future.result()
+
+
+def _dump_result(error, record):
+    """
+    return a worker_pool frame with [timestamp, error, name] metadata
+    and the record as the JSON line to output, sorted so we can diff
+    output
+    """
+    return workers.frame([
+        datetime.now().isoformat(),
+        error,
+        record.get('name', '') if record else None,
+        ], compact_json(record, sort_keys=True) if record else b'')
+
+
+def _latest_metadata_modified(ckan, arguments):
+    """
+    return the most recent metadata_modified value of all datasets,
+    or None if there are no datasets
+    """
+    requests_kwargs = None
+    if arguments['--insecure']:
+        requests_kwargs = {'verify': False}
+    result = ckan.call_action('package_search', {
+        'q': '*:*',
+        'sort': 'metadata_modified desc',
+        'rows': 1,
+        'include_private': bool(arguments.get('--include-private')),
+        'include_drafts': bool(arguments.get('--include-drafts')),
+        'include_deleted': True,
+        }, requests_kwargs=requests_kwargs)
+    if result['results']:
+        return result['results'][0]['metadata_modified']
+
+
+def _merge_changes(changes, arguments):
+    """
+    merge the changed records in the changes file into the existing
+    dump in --output, replacing records with the same id and removing
+    deleted datasets. Both are expected to be sorted by name.
+
+    returns a list of the ids of deleted datasets
+    """
+    deleted = []
+    changed = []
+    for line in changes:
+        record = codec.loads(line)
+        if record.get('state') == 'deleted' and not arguments.get(
+                '--include-deleted'):
+            deleted.append(record['id'])
+            line = None
+        changed.append((record.get('name', ''), record['id'], line))
+    changed_ids = set(c[1] for c in changed)
+    changed = iter(changed)
+    pending = next(changed, None)
+
+    output = arguments['--output']
+    opener = gzip.open if arguments['--gzip'] else open
+    with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(os.path.abspath(output)),
+            delete=False) as tmp:
+        with opener(output, 'rb') as old, opener(tmp.name, 'wb') as new:
+            for line in old:
+                record = codec.loads(line)
+                if record.get('id') in changed_ids:
+                    continue
+                while pending and pending[0] < record.get('name', ''):
+                    if pending[2]:
+                        new.write(pending[2])
+                    pending = next(changed, None)
+                new.write(line.rstrip(b'\n') + b'\n')
+            while pending:
+                if pending[2]:
+                    new.write(pending[2])
+                pending = next(changed, None)
+    os.replace(tmp.name, output)
+    return deleted
+
+
+def _search_result_incomplete(obj):
+    """
+    return True if a package_search result is known to be missing
+    values that package_show would return, e.g. indexes built by older
+    versions of CKAN that truncated resource or tag lists
+    """
+    resources = obj.get('resources')
+    if resources is None:
+        return True
+    if obj.get('num_resources', len(resources)) != len(resources):
+        return True
+    tags = obj.get('tags', [])
+    return obj.get('num_tags', len(tags)) != len(tags)
+
+
 def _worker_command_line(thing, arguments):
     """
     Create a worker command line suitable for Popen with only the
@@ -213,16 +454,20 @@ def _worker_command_line(thing, arguments):
     """
     def a(name):
         "options with values"
-        return [name, arguments[name]] * (arguments[name] is not None)
+        return [name, arguments.get(name)] * (
+            arguments.get(name) is not None)
     def b(name):
         "boolean options"
-        return [name] * bool(arguments[name])
+        return [name] * bool(arguments.get(name))
     return (
         ['ckanapi', 'dump', thing, '--worker']
         + a('--config')
         + a('--ckan-user')
         + a('--remote')
         + a('--apikey')
+        + a('--retries')
+        + b('--retry-writes')
+        + a('--max-rps')
         + b('--get-request')
         + b('--datastore-fields')
         + b('--resource-views')
@@ -231,20 +476,53 @@ def _worker_command_line(thing, arguments):
         )
 
 
-def populate_res_views(ckan, res):
+def populate_resources(ckan, resources, datastore_fields=False, views=False,
+        requests_kwargs=None, concurrent=True):
     """
-    update resource dict in-place with resource_view_list values
-    in every resource with views using ckan LocalCKAN/RemoteCKAN instance
+    update resource dicts in-place with datastore_fields values like
+    populate_datastore_res_fields and non-empty resource_view_list
+    values as resource_views, making the calls for all the resources
+    concurrently with RemoteCKAN.call_actions when concurrent is True
+    and the site has no parallel_limit
     """
-    try:
-        views = ckan.call_action('resource_view_list', {
-            'id': res['id'],
-            'limit':0})
-    except CKANAPIError:
+    calls = []
+    targets = []
+    for res in resources:
+        # only resources with datastore active have datastore fields
+        if datastore_fields and res.get('datastore_active', False):
+            calls.append(('datastore_search', {
+                'resource_id': res['id'],
+                'limit': 0}))
+            targets.append((res, 'datastore_fields'))
+        if views:
+            calls.append(('resource_view_list', {
+                'id': res['id'],
+                'limit': 0}))
+            targets.append((res, 'resource_views'))
+    if not calls:
         return
-    except NotFound:
-        return  # with localckan we'll get the real CKAN exception not a CKANAPIError subclass
-    if not views:
-        return # return if the resource views list is empty
-    res['resource_views'] = views
 
+    if (concurrent and isinstance(ckan, RemoteCKAN) and len(calls) > 1
+            and not hasattr(ckan, 'parallel_limit')):
+        # add your sites to CKANAPI_MY_SITES instead of removing
+        results = ckan.call_actions(calls, requests_kwargs=requests_kwargs,
+            # stay within the connections kept open by the session
+            max_workers=min(ckan.pool_maxsize, CALL_ACTIONS_WORKERS))
+    else:
+        results = []
+        for action, data_dict in calls:
+            try:
+                results.append(ckan.call_action(action, data_dict,
+                    requests_kwargs=requests_kwargs))
+            except Exception as e:
+                results.append(e)
+
+    for (res, key), result in zip(targets, results):
+        if isinstance(result, (CKANAPIError, NotFound)):
+            continue  # with localckan we'll get the real CKAN exception not a CKANAPIError subclass
+        if isinstance(result, Exception):
+            raise result
+        if key == 'datastore_fields':
+            res[key] = result['fields']
+        elif result:
+            res[key] = result  # empty resource views lists are left out
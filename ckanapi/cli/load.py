@@ -4,18 +4,39 @@ implementation of load cli command
 
 import sys
 import gzip
-import json
 import requests
 from datetime import datetime
+from functools import partial
 import re
 from urllib.parse import urlparse
 
+from ckanapi import codec
 from ckanapi.common import REQUEST_TIMEOUT
 from ckanapi.errors import (NotFound, NotAuthorized, ValidationError,
     SearchIndexError)
 from ckanapi.cli import workers
 from ckanapi.cli.utils import completion_stats, compact_json, quiet_int_pipe
 
+# values set by CKAN that are ignored when comparing records to find
+# ones that are unchanged, at any level of nesting
+SERVER_COMPUTED_FIELDS = frozenset([
+    'metadata_modified',
+    'metadata_created',
+    'revision_id',
+    'num_resources',
+    'num_tags',
+    'num_followers',
+    'package_count',
+    'tracking_summary',
+    'created',
+    'creator_user_id',
+    'organization',
+    'display_name',
+    'image_display_url',
+    'datastore_active',
+    'position',
+    ])
+
 
 def load_things(ckan, thing, arguments,
         worker_pool=None, stdin=None, stdout=None, stderr=None):
@@ -65,12 +86,10 @@ def load_things(ckan, thing, arguments,
             yield num, line
 
     cmd = _worker_command_line(thing, arguments)
-    processes = int(arguments['--processes'])
-    if hasattr(ckan, 'parallel_limit'):
-        # add your sites to CKANAPI_MY_SITES instead of removing
-        processes = min(processes, ckan.parallel_limit)
+    cmd, processes, pool_kwargs = workers.pool_options(ckan, arguments,
+        cmd, partial(load_things_worker, ckan, thing, arguments))
     stats = completion_stats(processes)
-    pool = worker_pool(cmd, processes, line_reader())
+    pool = worker_pool(cmd, processes, line_reader(), **pool_kwargs)
 
     failures = 0
     with quiet_int_pipe() as errors:
@@ -78,8 +97,7 @@ def load_things(ckan, thing, arguments,
             if not result:
                 # child exited with traceback
                 return 1
-            timestamp, action, error, response = json.loads(
-                result.decode('utf-8'))
+            timestamp, action, error, response = codec.loads(result)
             if error:
                 failures += 1
 
@@ -157,7 +175,7 @@ def load_things_worker(ckan, thing, arguments,
 
     for line in iter(stdin.readline, b''):
         try:
-            obj = json.loads(line.decode('utf-8'))
+            obj = codec.loads(line)
         except UnicodeDecodeError as e:
             obj = None
             reply('read', 'UnicodeDecodeError', str(e))
@@ -199,8 +217,13 @@ def load_things_worker(ckan, thing, arguments,
 
                 if existing:
                     _copy_from_existing_for_update(obj, existing, thing)
-
-                # FIXME: compare and reply when 'unchanged'?
+                    # uploads may be missing even when the metadata matches
+                    uploads = arguments.get('--upload-resources') or (
+                        arguments.get('--upload-logo'))
+                    if not uploads and _normalize(obj) == _normalize(existing):
+                        reply('unchanged', None,
+                            existing.get('name', existing.get('id')))
+                        continue
 
             if not existing and arguments['--update-only']:
                 reply('show', 'NotFound', [obj.get('id'), obj.get('name')])
@@ -241,16 +264,20 @@ def _worker_command_line(thing, arguments):
     """
     def a(name):
         "options with values"
-        return [name, arguments[name]] * (arguments[name] is not None)
+        return [name, arguments.get(name)] * (
+            arguments.get(name) is not None)
     def b(name):
         "boolean options"
-        return [name] * bool(arguments[name])
+        return [name] * bool(arguments.get(name))
     return (
         ['ckanapi', 'load', thing, '--worker']
         + a('--config')
         + a('--ckan-user')
         + a('--remote')
         + a('--apikey')
+        + a('--retries')
+        + a('--compress')
+        + b('--retry-writes')
         + b('--create-only')
         + b('--update-only')
         + b('--upload-resources')
@@ -274,6 +301,36 @@ def _copy_from_existing_for_update(obj, existing, thing):
         if 'users' not in obj and 'users' in existing:
             obj['users'] = existing['users']
 
+def _normalize(value):
+    """
+    return a copy of record value for comparing records: without
+    SERVER_COMPUTED_FIELDS (e.g. organization and position) at the top
+    level or in its resources, tags and groups, with tags reduced to
+    their name and vocabulary because tag ids differ between sites,
+    and with tags and extras in a consistent order
+    """
+    out = _strip_computed(value)
+    for k in ('resources', 'tags', 'groups'):
+        if isinstance(out.get(k), list):
+            out[k] = [_strip_computed(v) for v in out[k]]
+    if isinstance(out.get('tags'), list):
+        out['tags'] = [{'name': t.get('name'),
+            'vocabulary': t.get('vocabulary')} if isinstance(t, dict) else t
+            for t in out['tags']]
+    for k in ('tags', 'extras'):
+        if isinstance(out.get(k), list):
+            out[k] = sorted(out[k],
+                key=lambda v: compact_json(v, sort_keys=True))
+    return out
+
+
+def _strip_computed(value):
+    if not isinstance(value, dict):
+        return value
+    return dict((k, v) for k, v in value.items()
+        if k not in SERVER_COMPUTED_FIELDS)
+
+
 def _upload_resources(ckan,obj,arguments):
     resources = obj['resources']
     if not arguments['--upload-resources']:
@@ -6,27 +6,43 @@ Usage:
           [-j | -J] [-P PROFILE ]
           [[-c CONFIG] [-u USER] | -r SITE_URL [-a APIKEY] [-g] [--insecure]]
   ckanapi batch [-I JSONL_INPUT] [-s START] [-m MAX] [--local-files]
-          [-p PROCESSES] [-l LOG_FILE] [-qwz]
+          [-p PROCESSES | -t THREADS] [--adaptive] [--pipeline=DEPTH]
+          [-l LOG_FILE] [-qwz] [--compress=ENCODING]
+          [--retries=RETRIES [--retry-writes]] [--max-rps=RPS]
           [[-c CONFIG] [-u USER] | -r SITE_URL [-a APIKEY] [--insecure]]
   ckanapi delete (datasets | groups | organizations | users | related)
           (ID_OR_NAME ... | [-I JSONL_INPUT] [-s START] [-m MAX])
-          [-p PROCESSES] [-l LOG_FILE] [-qwz]
+          [-p PROCESSES | -t THREADS] [--adaptive] [--pipeline=DEPTH]
+          [-l LOG_FILE] [-qwz]
+          [--retries=RETRIES [--retry-writes]] [--max-rps=RPS]
           [[-c CONFIG] [-u USER] | -r SITE_URL [-a APIKEY] [--insecure]]
   ckanapi dump (datasets | groups | organizations | users | related)
-          (ID_OR_NAME ... | --all) ([-O JSONL_OUTPUT] | [-D DIRECTORY])
-          [-p PROCESSES] [-dqwzRU --include-private --include-drafts --include-deleted]
+          (ID_OR_NAME ... | --all)
+          ([-O JSONL_OUTPUT] | [-D DIRECTORY [--downloads=DOWNLOADS]
+          [--resource-store=STORE] [--datastore-csv]])
+          [-p PROCESSES | -t THREADS] [--adaptive] [--pipeline=DEPTH]
+          [-dqwzRU --include-private --include-drafts --include-deleted]
+          [--via-search] [--state-file=STATE_FILE] [--unordered]
+          [--retries=RETRIES [--retry-writes]] [--max-rps=RPS]
           [[-c CONFIG] [-u USER] | -r SITE_URL [-a APIKEY] [-g] [--insecure]]
   ckanapi load datasets
           [--upload-resources] [-I JSONL_INPUT] [-s START] [-m MAX]
-          [-p PROCESSES] [-l LOG_FILE] [-n | -o] [-qwz]
+          [-p PROCESSES | -t THREADS] [--adaptive] [--pipeline=DEPTH]
+          [-l LOG_FILE] [-n | -o] [-qwz] [--compress=ENCODING]
+          [--retries=RETRIES [--retry-writes]] [--max-rps=RPS]
           [[-c CONFIG] [-u USER] | -r SITE_URL [-a APIKEY] [--insecure]]
   ckanapi load (groups | organizations)
           [--upload-logo] [-I JSONL_INPUT] [-s START] [-m MAX]
-          [-p PROCESSES] [-l LOG_FILE] [-n | -o] [-qwzU]
+          [-p PROCESSES | -t THREADS] [--adaptive] [--pipeline=DEPTH]
+          [-l LOG_FILE] [-n | -o] [-qwzU] [--compress=ENCODING]
+          [--retries=RETRIES [--retry-writes]] [--max-rps=RPS]
           [[-c CONFIG] [-u USER] | -r SITE_URL [-a APIKEY] [--insecure]]
   ckanapi load (users | related)
-          [-I JSONL_INPUT] [-s START] [-m MAX] [-p PROCESSES] [-l LOG_FILE]
-          [-n | -o] [-qwz]
+          [-I JSONL_INPUT] [-s START] [-m MAX]
+          [-p PROCESSES | -t THREADS] [--adaptive]
+          [--pipeline=DEPTH] [-l LOG_FILE] [-n | -o] [-qwz]
+          [--compress=ENCODING]
+          [--retries=RETRIES [--retry-writes]] [--max-rps=RPS]
           [[-c CONFIG] [-u USER] | -r SITE_URL [-a APIKEY] [--insecure]]
   ckanapi search datasets
           [(KEY=STRING | KEY:JSON ) ... | -i | -I JSON_INPUT]
@@ -39,9 +55,18 @@ Options:
   -h --help                 show this screen
   --version                 show version
   -a --apikey=APIKEY        API key to use for remote actions
+  --adaptive                adjust the number of busy workers up to
+                            PROCESSES or THREADS based on response times
   --all                     all the things
+  --compress=ENCODING       compress large remote request bodies with gzip
+                            or br, the site must accept compressed requests
   -c --config=CONFIG        CKAN configuration file for local actions,
                             defaults to $CKAN_INI or development.ini
+  --downloads=DOWNLOADS     download up to DOWNLOADS resources at the same
+                            time with -D, at most 2 from each host
+                            [default: 8]
+  --datastore-csv           with -D write datastore tables as CSV from
+                            datastore_search instead of downloading them
   -d --datastore-fields     export datastore field information along with
                             resource metadata as datastore_fields lists
   --include-private         include private datasets in the dump
@@ -59,20 +84,40 @@ Options:
                             for file uploads
   -l --log=LOG_FILE         append messages generated to LOG_FILE
   -m --max-records=MAX      exit after processing MAX records
+  --max-rps=RPS             start at most RPS jobs per second, or with -t
+                            make at most RPS requests per second
   -n --create-only          create new records, don't update existing records
   --insecure                ignore verifying the SSL certificate for sites
                             using https
   -o --update-only          update existing records, don't create new records
   -O --output=JSONL_OUTPUT  output to json lines file instead of stdout
   -p --processes=PROCESSES  set the number of worker processes [default: 1]
+  --pipeline=DEPTH          queue up to DEPTH jobs on each worker so workers
+                            don't wait for the next job [default: 1]
   -P --profile=PROFILE      run action with cProfile and output to PROFILE
                             only local actions (no -r) will show internals
   -q --quiet                don't display progress messages
   -r --remote=URL           URL of CKAN server for remote actions
+  --retries=RETRIES         retry remote actions that only read data up to
+                            RETRIES times when they fail with a connection
+                            error or a 429, 502, 503 or 504 response
+  --retry-writes            also retry actions that may modify data, which
+                            may repeat changes the server did make
+  --resource-store=STORE    keep one copy of each resource downloaded with -D
+                            in STORE, hard linked into each datapackage
   -R --resource-views       export resource views information along with
                             resource metadata as resource_views lists
   -s --start-record=START   start from record number START, where the first
                             record is number 1 [default: 1]
+  -t --threads=THREADS      run workers as THREADS threads of this process
+                            sharing one connection pool instead of worker
+                            processes (remote actions only)
+  --state-file=STATE_FILE   dump only datasets modified since the last run
+                            recorded in STATE_FILE, merging them into
+                            the existing JSONL_OUTPUT, only with
+                            datasets --all -O JSONL_OUTPUT
+  --unordered               write records as they are completed instead of
+                            in the order they were requested
   -u --ckan-user=USER       perform actions as user with this name, uses the
                             site sysadmin user when not specified
   -U --include-users        include users of a group/organization
@@ -82,6 +127,9 @@ Options:
   --upload-resources        upload resources of a dataset that were uploaded to
                             server. Resources originally linked by external
                             urls will keep the urls,will not be uploaded
+  --via-search              dump datasets from paginated package_search
+                            results instead of calling package_show for each
+                            dataset, only with datasets --all
   -w --worker               launch worker process - used internally by load,
                             dump, delete and batch commands
   -z --gzip                 read/write gzipped data
@@ -94,6 +142,7 @@ import subprocess
 
 from ckanapi.version import __version__
 from ckanapi.remoteckan import RemoteCKAN
+from ckanapi.common import RetryPolicy
 from ckanapi.localckan import LocalCKAN
 from ckanapi.errors import CLIError
 from ckanapi.cli.load import load_things
@@ -122,14 +171,34 @@ def main(running_with_ckan_command=False):
     if not running_with_ckan_command and not arguments['--remote']:
         return _switch_to_ckan_click(arguments)
 
+    if arguments['--threads'] and not arguments['--remote']:
+        sys.stderr.write(
+            "worker threads are only supported for remote actions (-r)\n")
+        return 1
+
     if arguments['--remote']:
+        retry = None
+        if arguments['--retries']:
+            retry = RetryPolicy(
+                retries=int(arguments['--retries']),
+                retry_writes=arguments['--retry-writes'])
+        pool_kwargs = {}
+        if arguments['--threads']:
+            # one connection pool shared by all the worker threads
+            pool_kwargs['pool_maxsize'] = int(arguments['--threads'])
         ckan = RemoteCKAN(arguments['--remote'],
             apikey=arguments['--apikey'],
             user_agent="ckanapi-cli/{version} (+{url})".format(
                 version=__version__,
                 url='https://github.com/open-data/ckanapi'),
             get_only=arguments['--get-request'],
-            )
+            retry=retry,
+            # worker processes have their jobs paced by the parent
+            rate_limit=float(arguments['--max-rps'])
+                if arguments['--max-rps'] and not arguments['--worker']
+                else None,
+            compress=arguments.get('--compress'),
+            **pool_kwargs)
     else:
         ckan = LocalCKAN(username=arguments['--ckan-user'])
         # log execution of LocalCKAN commands
@@ -173,6 +242,10 @@ def main(running_with_ckan_command=False):
         sys.stderr.write(
             "multiple worker processes are not supported on windows\n")
         arguments['--processes'] = '1'
+    if arguments['--threads'] and os.name == 'nt':
+        sys.stderr.write(
+            "worker threads are not supported on windows\n")
+        arguments['--threads'] = None
 
     if arguments['load']:
         return load_things(ckan, thing[0], arguments)
@@ -4,11 +4,13 @@ implementation of the search datasets cli command
 
 import sys
 import gzip
-import json
 from os.path import expanduser
 
+from ckanapi import codec
 from ckanapi.cli.utils import compact_json, pretty_json
 from ckanapi.errors import CLIError
+from ckanapi.common import iter_action
+from ckanapi.remoteckan import RemoteCKAN
 
 
 ROWS_PER_QUERY = 1000  # match hard limit in some versions of ckan
@@ -30,11 +32,11 @@ def search_datasets(ckan, arguments, stdin=None, stdout=None, stderr=None):
     if arguments['--insecure']:
         requests_kwargs = {'verify': False}
     if arguments['--input-json']:
-        action_args = json.loads(stdin.read().decode('utf-8'))
+        action_args = codec.loads(stdin.read())
     elif arguments['--input']:
         action_args = {}
         with open(expanduser(arguments['--input'])) as in_f:
-            action_args = json.loads(
+            action_args = codec.loads(
                 in_f.read())
     else:
         action_args = {}
@@ -47,7 +49,7 @@ def search_datasets(ckan, arguments, stdin=None, stdout=None, stderr=None):
                 action_args[skey] = svalue
             elif len(skey) > len(jkey):
                 try:
-                    value = json.loads(jvalue)
+                    value = codec.loads(jvalue)
                 except ValueError:
                     raise CLIError("KEY:JSON argument %r has invalid JSON "
                         "value %r" % (jkey, jvalue))
@@ -62,23 +64,30 @@ def search_datasets(ckan, arguments, stdin=None, stdout=None, stderr=None):
     if arguments['--gzip']:
         jsonl_output = gzip.GzipFile(fileobj=jsonl_output)
 
-    start = int(action_args.get('start', 0))
-    while True:
-        args = action_args
-        if 'rows' not in action_args:
-            args = dict(action_args, start=start, rows=ROWS_PER_QUERY)
+    for r in search_records(ckan, action_args, requests_kwargs):
+        jsonl_output.write(compact_json(r, sort_keys=True) + b'\n')
+
+    if jsonl_output != stdout:
+        jsonl_output.close()
+
+
+def search_records(ckan, action_args, requests_kwargs=None):
+    """
+    call package_search with action_args and yield each dataset found,
+    paginating ROWS_PER_QUERY at a time unless 'rows' is in action_args
+    """
+    if 'rows' in action_args:
         result = ckan.call_action(
             'package_search',
-            args,
+            action_args,
             requests_kwargs=requests_kwargs
         )
-        rows = result['results']
-        for r in rows:
-            jsonl_output.write(compact_json(r, sort_keys=True) + b'\n')
-        if not rows or 'rows' in action_args:
-            break
-
-        start += len(rows)
+        return iter(result['results'])
 
-    if jsonl_output != stdout:
-        jsonl_output.close()
+    return iter_action(
+        ckan,
+        'package_search',
+        dict(action_args, rows=ROWS_PER_QUERY),
+        requests_kwargs=requests_kwargs,
+        prefetch=isinstance(ckan, RemoteCKAN)
+    )
@@ -4,9 +4,10 @@ useful bits of code not tied to ckanapi in any way
 
 import time
 
-import simplejson as json
 from contextlib import contextmanager
 
+from ckanapi import codec
+
 
 def completion_stats(window=1):
     """
@@ -44,14 +45,12 @@ def compact_json(r, sort_keys=False):
     """
     JSON as small as we can make it, with UTF-8
     """
-    return json.dumps(r, ensure_ascii=False, separators=(',', ':'),
-        sort_keys=sort_keys).encode('utf-8')
+    return codec.dumps(r, sort_keys=sort_keys)
 
 
 def pretty_json(r):
     """
     legible sorted JSON, with UTF-8
     """
-    return json.dumps(r, ensure_ascii=False, separators=(',', ': '),
-        indent=2, sort_keys=True).encode('utf-8')
+    return codec.dumps_pretty(r)
 
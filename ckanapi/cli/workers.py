@@ -1,9 +1,22 @@
-import select
+from collections import deque
+from itertools import chain
+import os
+import selectors
 import subprocess
+import threading
+import time
+
+from ckanapi import codec
+from ckanapi.common import TokenBucket
+from ckanapi.cli.utils import compact_json
+
+# maximum bytes read from a worker at a time
+READ_SIZE = 64 * 1024
 
 def worker_pool(popen_arg, num_workers, job_iterable,
         stop_when_jobs_done=True, stop_on_keyboard_interrupt=True,
-        popen=None):
+        popen=None, pipeline=1, window=None, limiter=None, max_rps=None,
+        framed=False):
     """
     Coroutine to manage a pool of workers that accept jobs as single lines
     of input on stdin and produces results as single lines of output.
@@ -29,91 +42,437 @@ def worker_pool(popen_arg, num_workers, job_iterable,
 
     when no jobs remain to be completed and stop_when_jobs_done is False a
     new job iterable must be sent to this generator with send().
+
+    popen - callable used instead of subprocess.Popen to create workers,
+            e.g. ThreadWorker
+    pipeline - maximum number of jobs queued on each worker's stdin.
+               Workers return results in the order jobs were received
+               so results are matched to the job ids queued for that
+               worker. The job id list contains the job each worker is
+               currently processing.
+    window - when set, job ids must be integers and no job is assigned
+             until the job window ids before it has finished, e.g. to
+             bound the results a caller holds while waiting for an
+             earlier job so it can return results in order
+    limiter - object with a limit attribute for the maximum number of
+              busy workers and a record(seconds) method called with
+              the time taken by each job, e.g. AdaptiveLimiter
+    max_rps - maximum number of jobs started per second
+    framed - True: workers produce results with frame() instead of
+             single lines, job result is the whole frame or empty if
+             the worker exited part way through one
     """
     if popen is None:
         popen = subprocess.Popen
 
     workers = []
-    job_ids = []
-    worker_fds = {}
+    job_queues = []
+    job_times = []
+    last_done = []
+    buffers = []
+    pending = []
+    eof = []
+    writing = set()
+    ready = deque()
     job_iter = iter(job_iterable)
+    lookahead = []
+    bucket = TokenBucket(max_rps) if max_rps else None
+    resume_at = None
+    try:
+        selector = selectors.DefaultSelector()
+    except AttributeError:
+        selector = None
+    if os.name == 'nt':
+        # XXX: no many-worker support on windows yet
+        selector = None
 
-    def start_job(worker=None):
+    def start_job(wnum=None):
         """
-        assign a job to exiting or newly created worker subprocess.
+        assign a job to exiting worker wnum or a newly created worker
+        subprocess.
 
-        returns (job_id, worker) or (None, None) when no more jobs
+        returns False when no more jobs
         """
-        job_id, job_str = next(job_iter, (None, None))
+        job_id, job_str = next_job()
         if job_str is None:
-            return None, None
+            return False
         job_str = job_str.rstrip(b'\n') + b'\n'
-        if not worker:
-            worker = popen(
+        if wnum is None:
+            w = popen(
                 popen_arg,
                 stdin=subprocess.PIPE,
                 stdout=subprocess.PIPE,
                 )
-        worker.stdin.write(job_str)
-        worker.stdin.flush()
-        return (job_id, worker)
+            wnum = len(workers)
+            workers.append(w)
+            job_queues.append(deque())
+            job_times.append(deque())
+            last_done.append(0)
+            buffers.append(bytearray())
+            pending.append(b'')
+            eof.append(False)
+            if selector:
+                os.set_blocking(w.stdin.fileno(), False)
+                selector.register(w.stdout, selectors.EVENT_READ, wnum)
+        pending[wnum] += job_str
+        job_queues[wnum].append(job_id)
+        job_times[wnum].append(time.monotonic())
+        send_jobs(wnum)
+        return True
+
+    def next_job():
+        """
+        return the next (job id, job string) or (None, None) when no
+        more jobs, the next job is outside window or must wait for
+        max_rps (setting resume_at)
+        """
+        nonlocal resume_at
+        if not lookahead:
+            lookahead.append(next(job_iter, (None, None)))
+        job_id, job_str = lookahead[0]
+        if job_str is None:
+            return None, None
+        if window and any(job_queues):
+            oldest = min(q[0] for q in job_queues if q)
+            if job_id - oldest >= window:
+                return None, None
+        if bucket:
+            wait = bucket.try_acquire()
+            if wait:
+                resume_at = time.monotonic() + wait
+                return None, None
+        return lookahead.pop()
+
+    def replace_jobs(new_jobs):
+        """
+        use new_jobs after any job held back by window
+        """
+        return chain([j for j in lookahead if j[1] is not None],
+            iter(new_jobs))
+
+    def send_jobs(wnum):
+        """
+        write as much pending job data to worker wnum as its stdin pipe
+        accepts, waiting for it to become writable for the rest
+        """
+        w = workers[wnum]
+        if not selector:
+            w.stdin.write(pending[wnum])
+            w.stdin.flush()
+            pending[wnum] = b''
+            return
+        try:
+            sent = os.write(w.stdin.fileno(), pending[wnum])
+        except BlockingIOError:
+            sent = 0
+        pending[wnum] = pending[wnum][sent:]
+        if pending[wnum] and wnum not in writing:
+            selector.register(w.stdin, selectors.EVENT_WRITE, wnum)
+            writing.add(wnum)
+        elif wnum in writing and not pending[wnum]:
+            selector.unregister(w.stdin)
+            writing.remove(wnum)
+
+    def receive(wnum):
+        """
+        read available output from worker wnum
+        """
+        w = workers[wnum]
+        data = os.read(w.stdout.fileno(), READ_SIZE)
+        if not data:
+            eof[wnum] = True
+            if selector:
+                selector.unregister(w.stdout)
+        else:
+            buffers[wnum] += data
+            if framed:
+                if result_end(wnum) is None:
+                    return
+            elif b'\n' not in data:
+                return
+        ready.append(wnum)
+
+    def result_end(wnum):
+        """
+        return the length of the first complete result in worker wnum's
+        buffer, or None
+        """
+        buf = buffers[wnum]
+        nl = buf.find(b'\n')
+        if nl < 0:
+            return None
+        if not framed:
+            return nl + 1
+        end = nl + 1 + int(buf[:buf.index(b' ')])
+        return end if len(buf) >= end else None
 
     def assign_jobs():
         """
         start as many jobs as possible given maximum/idle workers
-        and available jobs
+        and available jobs, giving every worker one job before
+        queuing more
         """
-        while None in job_ids:
-            wnum = job_ids.index(None)
-            job_ids[wnum], w = start_job(workers[wnum])
-            if w is None:
-                return
+        nonlocal resume_at
+        resume_at = None
+        busy = sum(1 for q in job_queues if q)
+        for depth in range(1, pipeline + 1):
+            for wnum in range(num_workers):
+                new = wnum >= len(workers)
+                if not new and (eof[wnum] or len(job_queues[wnum]) >= depth):
+                    continue
+                idle = new or not job_queues[wnum]
+                if idle and limiter and busy >= limiter.limit:
+                    continue
+                if not start_job(None if new else wnum):
+                    return
+                busy += idle
 
-        while len(workers) < num_workers:
-            job_id, w = start_job()
-            if w is None:
-                return
-            worker_fds[w.stdout] = len(workers)
-            workers.append(w)
-            job_ids.append(job_id)
+    def current_job_ids():
+        return [q[0] if q else None for q in job_queues]
+
+    def next_result():
+        """
+        return (wnum, result line) for the next complete line from a busy
+        worker, an empty result for a worker that has exited or
+        (None, None) when it's time to start more jobs after a max_rps
+        wait.
+
+        Each wait handles every worker that is ready, so results from
+        other workers are returned without waiting again. Results are
+        split here instead of with readline() because workers may send
+        more than one result in a single read.
+        """
+        while True:
+            while ready:
+                wnum = ready.popleft()
+                if not job_queues[wnum]:
+                    continue
+                buf = buffers[wnum]
+                end = result_end(wnum)
+                if end is not None:
+                    result = bytes(buf[:end])
+                    del buf[:end]
+                    if eof[wnum] or result_end(wnum) is not None:
+                        ready.append(wnum)
+                    return wnum, result
+                if eof[wnum]:
+                    # worker exited, return any partial line
+                    result = b'' if framed else bytes(buf)
+                    del buf[:]
+                    ready.append(wnum)
+                    return wnum, result
+
+            if not selector:
+                for wnum, q in enumerate(job_queues):
+                    if q:
+                        receive(wnum)
+                        break
+                continue
+
+            timeout = None
+            if resume_at is not None:
+                timeout = max(0, resume_at - time.monotonic())
+            events = selector.select(timeout)
+            if not events:
+                return None, None
+            for key, events in events:
+                if events & selectors.EVENT_WRITE:
+                    send_jobs(key.data)
+                if events & selectors.EVENT_READ:
+                    receive(key.data)
 
     try:
         assign_jobs()
         while True:
-            if all(i is None for i in job_ids):
+            if not any(job_queues):
+                if resume_at is not None:
+                    # waiting for max_rps
+                    time.sleep(max(0, resume_at - time.monotonic()))
+                    assign_jobs()
+                    continue
                 if stop_when_jobs_done:
                     return
                 new_jobs = yield (None, None, None)
                 # require new jobs to be submitted
-                job_iter = iter(new_jobs)
+                job_iter = replace_jobs(new_jobs)
+                del lookahead[:]
                 assign_jobs()
                 continue
 
             try:
-                readable, _, _ = select.select(worker_fds, [], [])
-            except select.error as e:
-                if e.args[0] == 10038:
-                    # XXX: no many-worker support on windows yet
-                    readable = list(worker_fds)[:1]
-                else:
-                    raise
+                wnum, result = next_result()
+                if wnum is None:
+                    assign_jobs()
+                    continue
             except KeyboardInterrupt:
                 if stop_on_keyboard_interrupt:
                     return
                 raise
 
-            fd = readable[0]
-            wnum = worker_fds[fd]
-            w = workers[wnum]
-            result = w.stdout.readline()
-            finished = job_ids[wnum]
-            job_ids[wnum], _ = start_job(w)
+            finished = job_queues[wnum].popleft()
+            started = job_times[wnum].popleft()
+            if limiter:
+                # time spent on this job, not waiting in the worker's queue
+                now = time.monotonic()
+                limiter.record(now - max(started, last_done[wnum]))
+                last_done[wnum] = now
+            if window or limiter or bucket:
+                # a finished job may let any idle worker continue
+                assign_jobs()
+            elif not eof[wnum]:
+                start_job(wnum)
 
-            new_jobs = yield (job_ids, finished, result)
+            new_jobs = yield (current_job_ids(), finished, result)
             if new_jobs:
-                job_iter = iter(new_jobs)
+                job_iter = replace_jobs(new_jobs)
+                del lookahead[:]
                 assign_jobs()
 
     finally:
+        if selector:
+            selector.close()
         for w in workers:
             w.stdin.close()
+
+
+def frame(meta, payload=b''):
+    """
+    return a worker result for worker_pool(framed=True): a header line
+    with the payload length and meta as JSON, followed by the payload
+    bytes which the parent may use without decoding them
+    """
+    return b'%d %s\n%s' % (len(payload), compact_json(meta), payload)
+
+
+def unframe(result):
+    """
+    return (meta, payload) from a result created by frame()
+    """
+    header, _nl, payload = result.partition(b'\n')
+    return codec.loads(header.partition(b' ')[2]), payload
+
+
+def pool_options(ckan, arguments, cmd, worker_fn):
+    """
+    return (popen_arg, num_workers, keyword arguments) for worker_pool
+    from the --processes, --threads, --max-rps, --pipeline and
+    --adaptive command line options
+
+    cmd - command line used to launch worker processes
+    worker_fn - function run in each thread with --threads, e.g.
+                functools.partial(load_things_worker, ckan, thing,
+                arguments)
+    """
+    processes = int(arguments['--processes'])
+    pool_kwargs = {}
+    if arguments.get('--threads'):
+        # run the worker code in threads sharing our ckan instance
+        cmd = worker_fn
+        processes = int(arguments['--threads'])
+        pool_kwargs['popen'] = ThreadWorker
+    elif arguments.get('--max-rps'):
+        # threads share the rate limited ckan instance, otherwise
+        # limit the rate jobs are given to worker processes
+        pool_kwargs['max_rps'] = float(arguments['--max-rps'])
+    if arguments.get('--pipeline', '1') != '1':
+        # keep workers busy with more than one job queued on stdin
+        pool_kwargs['pipeline'] = int(arguments['--pipeline'])
+    if arguments.get('--adaptive'):
+        # start at the parallel limit and adjust from response times
+        pool_kwargs['limiter'] = AdaptiveLimiter(processes,
+            initial=min(processes, getattr(ckan, 'parallel_limit', processes)))
+    elif hasattr(ckan, 'parallel_limit'):
+        # add your sites to CKANAPI_MY_SITES instead of removing
+        processes = min(processes, ckan.parallel_limit)
+    return cmd, processes, pool_kwargs
+
+
+class AdaptiveLimiter(object):
+    """
+    Additive-increase/multiplicative-decrease limit on the number of
+    busy workers for worker_pool.
+
+    After each round of jobs (at least limit jobs) the limit grows by one
+    while the 95th percentile job time stays within tolerance times the
+    best seen recently, and is cut to backoff times its value when job
+    times rise, e.g. from a slow server or requests being retried.
+
+    maximum - highest limit, normally the number of workers
+    initial - starting limit
+    minimum - lowest limit
+    tolerance - allowed ratio of a round's 95th percentile job time to
+                the baseline
+    backoff - factor applied to the limit when job times rise
+    """
+    # rounds with fewer jobs than this are too noisy to compare
+    MIN_SAMPLES = 10
+    # baseline allowed to rise this much each round to follow slow drift
+    BASELINE_DRIFT = 1.1
+
+    def __init__(self, maximum, initial=1, minimum=1, tolerance=2.0,
+            backoff=0.7):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = max(minimum, min(initial, maximum))
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.baseline = None
+        self.samples = []
+
+    def record(self, seconds):
+        """
+        record the time taken by a job, adjusting limit after each round
+        """
+        self.samples.append(seconds)
+        if len(self.samples) < max(self.limit, self.MIN_SAMPLES):
+            return
+        samples = sorted(self.samples)
+        self.samples = []
+        p95 = samples[int(len(samples) * 0.95)]
+        if self.baseline is None or p95 < self.baseline:
+            self.baseline = p95
+        if p95 > self.baseline * self.tolerance:
+            self.throttled()
+        else:
+            self.limit = min(self.maximum, self.limit + 1)
+        self.baseline *= self.BASELINE_DRIFT
+
+    def throttled(self):
+        """
+        reduce limit now, e.g. when the server reports it is overloaded
+        """
+        self.limit = max(self.minimum, int(self.limit * self.backoff))
+        self.samples = []
+
+
+class ThreadWorker(object):
+    """
+    Popen-compatible worker that runs a function in a thread of this
+    process instead of launching a worker subprocess.
+
+    popen_arg - function accepting binary file stdin= and stdout= keyword
+                arguments, e.g. functools.partial(dump_things_worker,
+                ckan, thing, arguments)
+
+    Jobs and results are passed through pipes in the same line format
+    used for worker processes. When the function returns or raises an
+    exception its stdout is closed, which the pool reports like a
+    worker process exiting.
+    """
+    def __init__(self, popen_arg, stdin=None, stdout=None):
+        job_read, job_write = os.pipe()
+        result_read, result_write = os.pipe()
+        self.stdin = os.fdopen(job_write, 'wb')
+        self.stdout = os.fdopen(result_read, 'rb')
+        self.thread = threading.Thread(
+            target=self._run,
+            args=(
+                popen_arg,
+                os.fdopen(job_read, 'rb'),
+                os.fdopen(result_write, 'wb')),
+            daemon=True)
+        self.thread.start()
+
+    def _run(self, target, stdin, stdout):
+        with stdin, stdout:
+            target(stdin=stdin, stdout=stdout)
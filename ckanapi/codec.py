@@ -0,0 +1,136 @@
+"""
+JSON encoding and decoding using the fastest available library:
+orjson, simplejson or the standard library json module
+
+Set CKANAPI_JSON to 'orjson', 'simplejson' or 'json' to choose one.
+
+Output is the same with each library except for floats written with an
+exponent or very small floats: orjson writes 1e16 and 0.00001 where the
+others write 1e+16 and 1e-05. Decoded values are the same.
+"""
+
+import os
+import re
+
+import json as _stdlib_json
+
+try:
+    import simplejson as _simplejson
+except ImportError:
+    _simplejson = None
+
+try:
+    import orjson as _orjson
+except ImportError:
+    _orjson = None
+
+# integers outside the 64-bit range that orjson would decode as floats,
+# with strings matched separately so digits inside them can be skipped
+_LONG_DIGITS = re.compile(br'\d{19}')
+_LONG_DIGITS_STR = re.compile(r'\d{19}')
+_LONG_NUMBER = re.compile(br'"[^"\\]*(?:\\.[^"\\]*)*"|\d{19}')
+_LONG_NUMBER_STR = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|\d{19}')
+
+
+class _StdlibCodec(object):
+    """
+    simplejson or json module for encoding, json module for decoding
+    because it accepts NaN and Infinity by default
+    """
+    def __init__(self, module):
+        self.module = module
+        self.name = module.__name__
+
+    def loads(self, s):
+        return _stdlib_json.loads(s)
+
+    def dumps(self, obj, sort_keys=False):
+        return self.module.dumps(obj, ensure_ascii=False,
+            separators=(',', ':'), sort_keys=sort_keys).encode('utf-8')
+
+    def dumps_pretty(self, obj):
+        return self.module.dumps(obj, ensure_ascii=False,
+            separators=(',', ': '), indent=2, sort_keys=True).encode('utf-8')
+
+
+class _OrjsonCodec(object):
+    """
+    orjson, falling back to fallback codec for values orjson doesn't
+    handle the same way: integers outside the 64-bit range, non-str keys,
+    Decimal and decoding NaN or Infinity. orjson encodes NaN and Infinity
+    as null, which is valid JSON unlike the other libraries' output.
+    """
+    name = 'orjson'
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+
+    def loads(self, s):
+        if _has_long_number(s):
+            return self.fallback.loads(s)
+        try:
+            return _orjson.loads(s)
+        except ValueError:
+            return self.fallback.loads(s)
+
+    def dumps(self, obj, sort_keys=False):
+        try:
+            return _orjson.dumps(obj,
+                option=_orjson.OPT_SORT_KEYS if sort_keys else 0)
+        except TypeError:
+            return self.fallback.dumps(obj, sort_keys=sort_keys)
+
+    def dumps_pretty(self, obj):
+        try:
+            return _orjson.dumps(obj,
+                option=_orjson.OPT_SORT_KEYS | _orjson.OPT_INDENT_2)
+        except TypeError:
+            return self.fallback.dumps_pretty(obj)
+
+
+def _has_long_number(s):
+    """
+    return True if JSON s contains an integer of 19 or more digits
+    outside of strings, e.g. not only in hashes or ids
+    """
+    if isinstance(s, bytes):
+        digits, number, quote = _LONG_DIGITS, _LONG_NUMBER, b'"'
+    else:
+        digits, number, quote = _LONG_DIGITS_STR, _LONG_NUMBER_STR, '"'
+    if not digits.search(s):
+        return False
+    return any(not m.group().startswith(quote) for m in number.finditer(s))
+
+
+def _choose_codec(name=None):
+    fallback = _StdlibCodec(_simplejson or _stdlib_json)
+    if name == 'json' or (name == 'simplejson' and not _simplejson):
+        return _StdlibCodec(_stdlib_json)
+    if name == 'simplejson' or not _orjson:
+        return fallback
+    return _OrjsonCodec(fallback)
+
+
+_codec = _choose_codec(os.getenv('CKANAPI_JSON'))
+BACKEND = _codec.name
+
+
+def loads(s):
+    """
+    decode JSON from str or UTF-8 bytes
+    """
+    return _codec.loads(s)
+
+
+def dumps(obj, sort_keys=False):
+    """
+    JSON as small as we can make it, as UTF-8 bytes
+    """
+    return _codec.dumps(obj, sort_keys=sort_keys)
+
+
+def dumps_pretty(obj):
+    """
+    legible sorted JSON, as UTF-8 bytes
+    """
+    return _codec.dumps_pretty(obj)
@@ -2,9 +2,17 @@
 Code shared by LocalCKAN, RemoteCKAN and TestCKAN
 """
 
+import codecs
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
 import json
 import os
+import random
+import re
+import threading
+import time
 
+from ckanapi import codec
 from ckanapi.errors import (CKANAPIError, NotAuthorized, NotFound,
     ValidationError, SearchQueryError, SearchError, SearchIndexError,
     ServerIncompatibleError)
@@ -17,6 +25,139 @@ if request_connection_timeout := os.getenv("CKANAPI_REQUEST_TIMEOUT"):
 else:
     REQUEST_TIMEOUT = None
 
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# actions supported by iter_action:
+# (page size parameter, offset parameter, page size, result list key)
+PAGINATED_ACTIONS = {
+    'package_search': ('rows', 'start', 1000, 'results'),
+    'datastore_search': ('limit', 'offset', 10000, 'records'),
+    'package_list': ('limit', 'offset', 1000, None),
+    'group_list': ('limit', 'offset', 1000, None),
+    'organization_list': ('limit', 'offset', 1000, None),
+    'user_list': ('limit', 'offset', 1000, None),
+    'current_package_list_with_resources': ('limit', 'offset', 100, None),
+    }
+# default maximum for group_list and organization_list with all_fields
+ALL_FIELDS_PAGE_SIZE = 25
+
+# CKAN actions with these name endings don't modify anything
+READ_ONLY_ACTION_SUFFIXES = ('_show', '_list', '_search', '_autocomplete',
+    '_count', '_read')
+
+
+def is_read_only_action(action):
+    """
+    True if action only reads data, so it is safe to repeat
+    """
+    return action.endswith(READ_ONLY_ACTION_SUFFIXES) or action.startswith(
+        'am_following_')
+
+
+class RetryPolicy(object):
+    """
+    Retry RemoteCKAN requests that fail with a connection error, timeout
+    or temporary server error, waiting with jittered exponential backoff
+    or as long as the server's Retry-After header asks.
+
+    :param retries: maximum number of times to retry a call
+    :param backoff: seconds to wait before the first retry, doubled for
+                    each retry that follows
+    :param max_backoff: maximum seconds to wait between retries unless
+                        the server sends a Retry-After header
+    :param retry_writes: also retry actions that may modify data, which
+                         may repeat a change the server did make
+    :param statuses: HTTP status codes to retry
+
+    Override should_retry or delay to customize.
+    """
+    def __init__(self, retries=3, backoff=0.5, max_backoff=60,
+            retry_writes=False, statuses=(429, 502, 503, 504)):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_writes = retry_writes
+        self.statuses = frozenset(statuses)
+
+    def should_retry(self, action, attempt, status=None):
+        """
+        True to retry action after attempt number attempt (starting
+        from 0) failed with HTTP status or a connection error (None)
+        """
+        if attempt >= self.retries:
+            return False
+        if status is not None and status not in self.statuses:
+            return False
+        return self.retry_writes or is_read_only_action(action)
+
+    def delay(self, attempt, retry_after=None):
+        """
+        return seconds to wait before retrying after attempt number
+        attempt failed, retry_after is the Retry-After header value
+        """
+        wait = _parse_retry_after(retry_after)
+        if wait is not None:
+            return wait
+        return random.uniform(0, min(self.max_backoff,
+            self.backoff * 2 ** attempt))
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket allowing rate operations per second on
+    average, with bursts of up to burst operations
+
+    :param rate: operations per second
+    :param burst: operations allowed at once after being idle
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        """
+        take a token if one is available and return 0, otherwise
+        return the seconds until one will be available
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """
+        take a token, waiting until one is available
+        """
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+def _parse_retry_after(value):
+    """
+    return seconds from a Retry-After header value or None
+    """
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
 class ActionShortcut(object):
     """
     ActionShortcut(foo).bar(baz=2) <=> foo.call_action('bar', {'baz':2})
@@ -31,6 +172,11 @@ class ActionShortcut(object):
 
         pkg = demo.call_action('package_show', {'id':'adur_district_spending'})
 
+    For AsyncRemoteCKAN instances call_action is a coroutine so the
+    shortcut returns an awaitable::
+
+        pkg = await demo.action.package_show(id='adur_district_spending')
+
     File-like values (objects with a 'read' attribute) are
     sent as file-uploads::
 
@@ -91,7 +237,7 @@ def prepare_action(action, data_dict=None, apikey=None, files=None,
                 v = str(v)
             data_dict[k.encode('utf-8')] = v.encode('utf-8')
     else:
-        data_dict = json.dumps(data_dict).encode('ascii')
+        data_dict = codec.dumps(data_dict)
         headers['Content-Type'] = 'application/json'
     if apikey:
         apikey = str(apikey)
@@ -107,7 +253,7 @@ def reverse_apicontroller_action(url, status, response):
     exception -> HTTP response translation that ApiController.action does
     """
     try:
-        parsed = json.loads(response)
+        parsed = codec.loads(response)
         if parsed.get('success'):
             return parsed['result']
         if hasattr(parsed, 'get'):
@@ -141,3 +287,267 @@ def reverse_apicontroller_action(url, status, response):
 
     # don't recognize the error
     raise CKANAPIError(repr([url, status, response]))
+
+
+def iter_action_result(url, status, chunks, key=None):
+    """
+    Parse an API response incrementally from chunks of bytes, yielding
+    the elements of the list returned as the result (or of the list
+    result[key] when key is given) as they arrive.
+
+    Responses that are not successful are converted to exceptions the
+    same way as reverse_apicontroller_action.
+    """
+    stream = _JSONStream(chunks)
+    members = {}
+    try:
+        stream.expect('{')
+        while stream.peek() != '}':
+            name = stream.value()
+            stream.expect(':')
+            if name == 'result':
+                if key is None:
+                    if stream.peek() != '[':
+                        raise CKANAPIError(
+                            "stream requires a list result from %s" % url)
+                else:
+                    stream.find_member(key)
+                    if stream.peek() != '[':
+                        raise CKANAPIError("stream requires a list "
+                            "result[%r] from %s" % (key, url))
+                for value in stream.array():
+                    yield value
+                return
+            members[name] = stream.value()
+            if stream.peek() == ',':
+                stream.expect(',')
+    except ValueError:
+        raise CKANAPIError(repr([url, status, 'invalid JSON response']))
+    reverse_apicontroller_action(url, status, codec.dumps(members))
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_NUMBER_TAIL = re.compile(r'[0-9.eE+-]*')
+_DECODER = json.JSONDecoder()
+
+class _JSONStream(object):
+    """
+    Minimal incremental JSON tokenizer for iter_action_result: containers
+    are walked one member at a time, other values are decoded whole.
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _more(self):
+        """
+        append at least as much text as is currently unconsumed so that
+        reparsing large values stays linear, return False at end of input
+        """
+        if self.eof:
+            return False
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        want = len(self.buf) + 1
+        text = [self.buf]
+        size = 0
+        while size < want:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                text.append(self.decoder.decode(b'', final=True))
+                self.eof = True
+                break
+            chunk = self.decoder.decode(chunk)
+            text.append(chunk)
+            size += len(chunk)
+        self.buf = ''.join(text)
+        return True
+
+    def peek(self):
+        """
+        skip whitespace and return the next character, '' at end of input
+        """
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._more():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('expected %r' % char)
+        self.pos += 1
+
+    def value(self):
+        """
+        decode and return the next complete value
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self._more():
+                    raise
+                continue
+            if isinstance(value, (int, float)) and _NUMBER_TAIL.match(
+                    self.buf, end).end() == len(self.buf) and self._more():
+                continue  # numbers may continue in the next chunk
+            self.pos = end
+            return value
+
+    def array(self):
+        """
+        yield the values of the array that follows
+        """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ']':
+                self.pos += 1
+                return
+            self.expect(',')
+
+    def find_member(self, name):
+        """
+        skip through the object that follows until the value of member name
+        """
+        self.expect('{')
+        while self.peek() != '}':
+            key = self.value()
+            self.expect(':')
+            if key == name:
+                return
+            self.value()
+            if self.peek() == ',':
+                self.expect(',')
+        raise CKANAPIError("%r not found in result" % name)
+
+
+def iter_action(ckan, action, data_dict=None, requests_kwargs=None,
+        keyset=False, prefetch=True):
+    """
+    Generator calling a list or search action repeatedly to retrieve
+    every page of results, yielding each record.
+
+    :param ckan: LocalCKAN or RemoteCKAN instance
+    :param action: an action in PAGINATED_ACTIONS, e.g. 'package_search'
+    :param data_dict: the dict to pass to the action, a page size or
+                      offset value given (e.g. 'rows' and 'start' for
+                      package_search) is used for the first page
+    :param requests_kwargs: kwargs for requests get/post calls
+    :param keyset: True to page through a datastore_search resource by
+                   _id with datastore_search_sql instead of by offset
+    :param prefetch: True to request the next page on a background
+                     thread while the current page is being consumed
+    """
+    pager = _Pager(action, data_dict, keyset)
+
+    def fetch(call):
+        return pager.rows(ckan.call_action(call[0], call[1],
+            requests_kwargs=requests_kwargs))
+
+    executor = ThreadPoolExecutor(1) if prefetch else None
+    try:
+        rows = fetch(pager.next_call())
+        while True:
+            call = pager.next_call()
+            future = None
+            if call and executor:
+                future = executor.submit(fetch, call)
+            for r in rows:
+                yield r
+            if not call:
+                return
+            rows = future.result() if future else fetch(call)
+    finally:
+        if executor:
+            executor.shutdown(wait=False)
+
+
+class _Pager(object):
+    """
+    Pagination state for iter_action. next_call returns the action and
+    data_dict for the next page, then rows extracts the records from the
+    result of that call.
+    """
+    def __init__(self, action, data_dict=None, keyset=False):
+        if action not in PAGINATED_ACTIONS:
+            raise CKANAPIError("iter_action does not support %r" % action)
+        self.limit_param, self.offset_param, page_size, self.key = (
+            PAGINATED_ACTIONS[action])
+        data_dict = dict(data_dict or {})
+        if action in ('group_list', 'organization_list') and data_dict.get(
+                'all_fields'):
+            page_size = ALL_FIELDS_PAGE_SIZE
+        self.page_size = int(data_dict.pop(self.limit_param, page_size))
+        self.offset = int(data_dict.pop(self.offset_param, 0))
+        self.data_dict = data_dict
+        self.action = action
+        self.previous = None
+        self.done = False
+        self.keyset = keyset
+        if keyset:
+            if action != 'datastore_search' or set(data_dict) != set(
+                    ['resource_id']) or '"' in data_dict['resource_id']:
+                raise CKANAPIError("keyset paging requires datastore_search "
+                    "with only a resource_id")
+            self.fields = None
+            self.last_id = 0
+
+    def next_call(self):
+        """
+        return (action, data_dict) for the next page or None when done
+        """
+        if self.done:
+            return None
+        if self.keyset:
+            if self.fields is None:
+                return 'datastore_search', dict(self.data_dict, limit=0)
+            return 'datastore_search_sql', {'sql':
+                'SELECT %s FROM "%s" WHERE _id > %d ORDER BY _id LIMIT %d' % (
+                    ', '.join('"%s"' % f.replace('"', '""')
+                        for f in self.fields),
+                    self.data_dict['resource_id'],
+                    self.last_id,
+                    self.page_size)}
+        return self.action, dict(self.data_dict, **{
+            self.limit_param: self.page_size,
+            self.offset_param: self.offset})
+
+    def rows(self, result):
+        """
+        return the list of records in result, update state for next_call
+        """
+        if self.keyset:
+            if self.fields is None:
+                self.fields = [f['id'] for f in result['fields']]
+                return []
+            rows = result['records']
+            self.done = len(rows) < self.page_size
+            if rows:
+                self.last_id = int(rows[-1]['_id'])
+            return rows
+
+        rows = result if self.key is None else result[self.key]
+        if not rows or rows == self.previous:
+            # empty page, or server ignoring our offset
+            self.done = True
+            return []
+        self.offset += len(rows)
+        self.previous = rows
+        if len(rows) > self.page_size:
+            self.done = True  # server ignoring our page size
+        elif self.key == 'results' and self.offset >= result['count']:
+            self.done = True
+        elif self.key == 'records' and 'total' in result and not result.get(
+                'total_was_estimated') and self.offset >= result['total']:
+            self.done = True
+        return rows
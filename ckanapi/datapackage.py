@@ -1,14 +1,31 @@
+from collections import defaultdict, deque
+from itertools import chain
+from concurrent.futures import Future, ThreadPoolExecutor
+import csv
+import hashlib
 import os
+import shutil
+import threading
+from urllib.parse import urlparse
+
 import requests
-import json
 
 import slugify
 
+from ckanapi import codec
 from ckanapi.common import REQUEST_TIMEOUT
+from ckanapi.remoteckan import RemoteCKAN
 from ckanapi.cli.utils import pretty_json
 from ckanapi.errors import CKANAPIError, NotFound
 
 DL_CHUNK_SIZE = 100 * 1024
+# resources downloaded at the same time by a DownloadPool
+DOWNLOAD_WORKERS = 8
+# resources downloaded at the same time from each host
+DOWNLOADS_PER_HOST = 2
+# hash algorithms for CKAN resource hash values without an "algorithm:"
+# prefix, by number of hex digits
+HASH_LENGTHS = {32: 'md5', 40: 'sha1', 64: 'sha256', 128: 'sha512'}
 DATAPACKAGE_TYPES = {  # map datastore types to datapackage types
     'text': 'string',
     'numeric': 'number',
@@ -16,32 +33,336 @@ DATAPACKAGE_TYPES = {  # map datastore types to datapackage types
 }
 
 
-def create_resource(resource, filename, datapackage_dir, stderr, apikey):
+def create_resource(resource, filename, datapackage_dir, stderr, apikey,
+        store=None):
     '''Downloads the resource['url'] to disk.
+
+    Skips the download when the file is already there and matches the
+    resource size and hash, if known. Data is written to a .part file
+    first and a .part file left by an earlier attempt is resumed with
+    an HTTP Range request, if the server sent an ETag or Last-Modified
+    value to check that the file is unchanged with If-Range.
+
+    With a DownloadStore store the file is downloaded into the store
+    once and linked from datapackage_dir.
     '''
     path = os.path.join('data', filename)
-    headers = {}
-    headers['X-CKAN-API-Key'] = apikey
-    headers['Authorization'] = apikey
+    full_path = os.path.join(datapackage_dir, path)
+    if os.path.exists(full_path) and not _download_mismatch(
+            full_path, resource):
+        return dict(resource, path=path)
 
     try:
-        r = requests.get(resource['url'], headers=headers, stream=True, timeout=REQUEST_TIMEOUT)
-        with open(os.path.join(datapackage_dir, path), 'wb') as f:
-            for chunk in r.iter_content(chunk_size=DL_CHUNK_SIZE):
-                if chunk: # filter out keep-alive new chunks
-                    f.write(chunk)
+        if store:
+            store.add(resource, full_path, stderr, apikey)
+        else:
+            _download(resource, full_path, stderr, apikey)
         return dict(resource, path=path)
     except requests.ConnectionError:
-        stderr.write('URL {url} refused connection. The resource will not be downloaded\n'.format(url=resource['url']))
+        stderr.write('URL {url} refused connection. The resource will not be downloaded\n'.format(url=resource['url']).encode('utf-8'))
     except requests.exceptions.RequestException as e:
-        stderr.write(str(e.args[0]) if len(e.args) > 0 else '')
-        stderr.write('\n')
+        stderr.write((str(e.args[0]) if len(e.args) > 0 else '').encode('utf-8'))
+        stderr.write(b'\n')
     except Exception as e:
-        stderr.write(str(e.args[0]) if len(e.args) > 0 else '')
+        stderr.write((str(e.args[0]) if len(e.args) > 0 else '').encode('utf-8'))
     return resource
 
 
-def create_datapackage(record, base_path, stderr, apikey):
+def create_datastore_csv(ckan, resource, filename, datapackage_dir, stderr):
+    '''Writes the datastore table of resource to disk as CSV, paging
+    through the records by _id so that large tables use little memory.
+
+    resource must have datastore_fields, see
+    populate_datastore_res_fields. Existing files are kept.
+    '''
+    path = os.path.join('data', filename)
+    full_path = os.path.join(datapackage_dir, path)
+    if os.path.exists(full_path):
+        return dict(resource, path=path)
+    part_path = full_path + '.part'
+    fields = [f['id'] for f in resource['datastore_fields'] if f['id'] != '_id']
+
+    try:
+        records = ckan.iter_action('datastore_search',
+            {'resource_id': resource['id']}, keyset=True)
+        try:
+            first = next(records, None)
+        except Exception:
+            # datastore_search_sql is disabled on many sites
+            records = ckan.iter_action('datastore_search',
+                {'resource_id': resource['id'], 'sort': '_id'})
+            first = next(records, None)
+        with open(part_path, 'w', newline='', encoding='utf-8') as f:
+            out = csv.writer(f)
+            out.writerow(fields)
+            if first is not None:
+                for r in chain([first], records):
+                    out.writerow([_csv_value(r.get(k)) for k in fields])
+        os.replace(part_path, full_path)
+        return dict(resource, path=path)
+    except Exception as e:
+        stderr.write('Datastore table {id} not written: {error}\n'.format(
+            id=resource['id'], error=e).encode('utf-8'))
+    return resource
+
+
+def _csv_value(value):
+    """
+    return a datastore value as written to CSV
+    """
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        return codec.dumps(value).decode('utf-8')
+    return value
+
+
+def _download(resource, file_path, stderr, apikey):
+    """
+    download resource['url'] to file_path through file_path + '.part',
+    resuming a .part file left by an earlier attempt if the file is
+    unchanged on the server
+
+    Returns 'size' or 'hash' if the file doesn't match the resource,
+    or None.
+    """
+    part_path = file_path + '.part'
+    validator_path = part_path + '.validator'
+    headers = {}
+    headers['X-CKAN-API-Key'] = apikey
+    headers['Authorization'] = apikey
+
+    offset = 0
+    if os.path.exists(part_path) and os.path.exists(validator_path):
+        offset = os.path.getsize(part_path)
+    if offset:
+        with open(validator_path) as f:
+            # the server sends the whole file if it has changed
+            headers['If-Range'] = f.read()
+        headers['Range'] = 'bytes=%d-' % offset
+    r = requests.get(resource['url'], headers=headers, stream=True, timeout=REQUEST_TIMEOUT)
+    with r:
+        # 416: nothing left to download after offset
+        if r.status_code != 416 or not offset:
+            r.raise_for_status()
+            if r.status_code != 206:
+                _write_validator(validator_path, r)
+            # servers that ignore Range send the whole file again
+            mode = 'ab' if r.status_code == 206 else 'wb'
+            with open(part_path, mode) as f:
+                for chunk in r.iter_content(chunk_size=DL_CHUNK_SIZE):
+                    if chunk: # filter out keep-alive new chunks
+                        f.write(chunk)
+    mismatch = _download_mismatch(part_path, resource)
+    if mismatch:
+        stderr.write('URL {url} {mismatch} does not match the resource\n'.format(
+            url=resource['url'], mismatch=mismatch).encode('utf-8'))
+    os.replace(part_path, file_path)
+    if os.path.exists(validator_path):
+        os.remove(validator_path)
+    return mismatch
+
+
+def _write_validator(validator_path, response):
+    """
+    save the strong ETag or Last-Modified value of response used to
+    resume the download with If-Range, or remove the file when there
+    is neither
+    """
+    validator = response.headers.get('ETag')
+    if not validator or validator.startswith('W/'):
+        validator = response.headers.get('Last-Modified')
+    if validator:
+        with open(validator_path, 'w') as f:
+            f.write(validator)
+    elif os.path.exists(validator_path):
+        os.remove(validator_path)
+
+
+class DownloadStore(object):
+    """
+    Content-addressed store of downloaded resources, so that a file
+    referenced by many resources is downloaded once and hard linked
+    into each datapackage (or copied where hard links aren't possible).
+
+    Files are stored by resource hash when CKAN has one, otherwise by
+    URL. A download that doesn't match its resource hash is stored by
+    URL instead, so a file's name always matches its content.
+
+    :param path: store directory, created if it doesn't exist
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._verified = set()
+
+    def key(self, resource):
+        """
+        return the name resource is stored under
+        """
+        algorithm, digest = _parse_hash(resource.get('hash'))
+        if algorithm:
+            return algorithm + '-' + digest
+        return self._url_key(resource)
+
+    def _url_key(self, resource):
+        return 'url-' + hashlib.sha256(
+            resource['url'].encode('utf-8')).hexdigest()
+
+    def _stored(self, key):
+        return os.path.join(self.path, key[-2:], key)
+
+    def add(self, resource, file_path, stderr, apikey):
+        """
+        download resource into the store unless already present and
+        link it as file_path
+        """
+        key = self.key(resource)
+        stored = self._stored(key)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        # concurrent downloads of the same resource wait for the first
+        with key_lock:
+            if key not in self._verified:
+                if not os.path.exists(stored) or _download_mismatch(
+                        stored, resource):
+                    os.makedirs(os.path.dirname(stored), exist_ok=True)
+                    if _download(resource, stored, stderr, apikey) and (
+                            key != self._url_key(resource)):
+                        by_url = self._stored(self._url_key(resource))
+                        os.makedirs(os.path.dirname(by_url), exist_ok=True)
+                        os.replace(stored, by_url)
+                        _link(by_url, file_path)
+                        return
+                self._verified.add(key)
+        _link(stored, file_path)
+
+
+def _link(source, file_path):
+    """
+    hard link or copy source to file_path, replacing file_path
+    """
+    tmp_path = file_path + '.link'
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, file_path)
+
+
+def _download_mismatch(file_path, resource):
+    """
+    return 'size' or 'hash' if the file doesn't match the resource
+    size or hash, or None
+    """
+    try:
+        size = int(resource.get('size') or 0)
+    except (TypeError, ValueError):
+        size = 0
+    if size and os.path.getsize(file_path) != size:
+        return 'size'
+    algorithm, digest = _parse_hash(resource.get('hash'))
+    if algorithm:
+        h = hashlib.new(algorithm)
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(DL_CHUNK_SIZE), b''):
+                h.update(chunk)
+        if h.hexdigest() != digest:
+            return 'hash'
+
+
+def _parse_hash(value):
+    """
+    return (algorithm, hex digest) for a CKAN resource hash value like
+    "sha256:..." or a bare hex digest, or (None, None) if unknown
+    """
+    if not value or not isinstance(value, str):
+        return None, None
+    algorithm, _sep, digest = value.strip().lower().rpartition(':')
+    if not algorithm:
+        algorithm = HASH_LENGTHS.get(len(digest))
+    if algorithm not in hashlib.algorithms_available or not digest or (
+            digest.strip('0123456789abcdef')):
+        return None, None
+    return algorithm, digest
+
+
+class DownloadPool(object):
+    """
+    Thread pool for resource downloads that limits the downloads from
+    each host, so one slow server doesn't hold up the rest. Downloads
+    waiting for their host don't occupy a thread.
+
+    :param max_workers: number of downloads at the same time
+    :param per_host: number of downloads at the same time from one host
+    """
+    def __init__(self, max_workers=DOWNLOAD_WORKERS,
+            per_host=DOWNLOADS_PER_HOST):
+        self.per_host = per_host
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._lock = threading.Lock()
+        self._active = defaultdict(int)
+        self._waiting = defaultdict(deque)
+
+    def submit(self, url, fn, *args):
+        """
+        call fn(*args) to download url when a thread and a slot for
+        url's host are available, returns a Future
+        """
+        host = urlparse(url).netloc
+        future = Future()
+        with self._lock:
+            if self._active[host] >= self.per_host:
+                self._waiting[host].append((future, fn, args))
+                return future
+            self._active[host] += 1
+        self._executor.submit(self._run, host, future, fn, args)
+        return future
+
+    def _run(self, host, future, fn, args):
+        while future:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+            with self._lock:
+                if self._waiting[host]:
+                    future, fn, args = self._waiting[host].popleft()
+                else:
+                    future = None
+                    self._active[host] -= 1
+                    if not self._active[host]:
+                        del self._active[host]
+                        self._waiting.pop(host, None)
+
+    def shutdown(self, wait=True):
+        """
+        wait for all downloads submitted to finish when wait is True
+        """
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+
+def create_datapackage(record, base_path, stderr, apikey, download_pool=None,
+        store=None, ckan=None):
+    """
+    write datapackage.json for record and download its resources, in
+    the background if a DownloadPool download_pool is given and through
+    DownloadStore store if given
+
+    With a LocalCKAN/RemoteCKAN instance ckan, resources in the datastore
+    are written as CSV from datastore_search instead of being downloaded.
+    """
     # TODO: how are we going to handle which resources to
     # leave alone? They're very inconsistent in some instances
     # And I can't imagine anyone wants to download a copy
@@ -50,7 +371,8 @@ def create_datapackage(record, base_path, stderr, apikey):
     dataset_name = record.get('name', '')
 
     datapackage_dir = os.path.join(base_path, dataset_name)
-    os.makedirs(os.path.join(datapackage_dir, 'data'))
+    # files already downloaded are kept so an export can be run again
+    os.makedirs(os.path.join(datapackage_dir, 'data'), exist_ok=True)
 
     # filter out some resources
     ckan_resources = []
@@ -64,11 +386,28 @@ def create_datapackage(record, base_path, stderr, apikey):
     datapackage = dataset_to_datapackage(dataset)
 
     for cres, dres in zip(ckan_resources, datapackage.get('resources', [])):
+        if ckan and cres.get('datastore_active') and 'datastore_fields' in cres:
+            dres['format'] = 'csv'
+            filename = resource_filename(dres)
+            args = (ckan, cres, filename, datapackage_dir, stderr)
+            # LocalCKAN isn't thread-safe, only RemoteCKAN runs in the pool
+            if download_pool and isinstance(ckan, RemoteCKAN):
+                download_pool.submit(ckan.address, create_datastore_csv, *args)
+            else:
+                create_datastore_csv(*args)
+            dres['path'] = 'data/' + filename
+            populate_schema_from_datastore(cres, dres)
+            continue
+
         filename = resource_filename(dres)
 
         # download the resource
-        cres = \
-            create_resource(resource, filename, datapackage_dir, stderr, apikey)
+        if download_pool:
+            download_pool.submit(cres['url'], create_resource,
+                cres, filename, datapackage_dir, stderr, apikey, store)
+        else:
+            create_resource(cres, filename, datapackage_dir, stderr, apikey,
+                store)
         dres['path'] = 'data/' + filename
 
         populate_schema_from_datastore(cres, dres)
@@ -172,7 +511,7 @@ def _convert_to_datapackage_resource(resource_dict):
     schema = resource_dict.get('schema')
     if isinstance(schema, str):
         try:
-            resource['schema'] = json.loads(schema)
+            resource['schema'] = codec.loads(schema)
         except ValueError:
             # Assume it's a path or URL
             resource['schema'] = schema
@@ -322,7 +661,7 @@ def _parse_extras(dataset_dict):
 
     for extra in extras:
         try:
-            extra[1] = json.loads(extra[1])
+            extra[1] = codec.loads(extra[1])
         except (ValueError, TypeError):
             pass
 
@@ -1,7 +1,7 @@
 from tempfile import TemporaryFile
 
 from ckanapi.errors import CKANAPIError
-from ckanapi.common import ActionShortcut
+from ckanapi.common import ActionShortcut, iter_action
 
 COPY_CHUNK = 1024*1024
 
@@ -16,8 +16,10 @@ class LocalCKAN(object):
                     value
     """
     def __init__(self, username=None, context=None):
-        from ckan.logic import get_action
-        self._get_action = get_action
+        import ckan.logic
+        self._logic = ckan.logic
+        self._get_action = ckan.logic.get_action
+        self._actions = {}
 
         if username is None:
             username = self.get_site_username()
@@ -29,8 +31,26 @@ class LocalCKAN(object):
         user = self._get_action('get_site_user')({'ignore_auth': True}, ())
         return user['name']
 
+    def clear_action_cache(self):
+        """
+        forget action functions looked up by call_action, e.g. after
+        loading or unloading plugins that CKAN hasn't been told about
+        """
+        self._actions.clear()
+
+    def _action_function(self, action):
+        """
+        return the action function for action, cached while it is still
+        the one in CKAN's own action cache
+        """
+        fn = self._actions.get(action)
+        actions = getattr(self._logic, '_actions', None)
+        if fn is None or actions is None or actions.get(action) is not fn:
+            fn = self._actions[action] = self._get_action(action)
+        return fn
+
     def call_action(self, action, data_dict=None, context=None, apikey=None,
-            files=None, requests_kwargs=None):
+            files=None, requests_kwargs=None, stream=False, copy_dicts=True):
         """
         :param action: the action name, e.g. 'package_create'
         :param data_dict: the dict to pass to the action, defaults to {}
@@ -39,11 +59,26 @@ class LocalCKAN(object):
         :param apikey: not supported
         :param files: None or {field-name: file-to-be-sent, ...}
         :param requests_kwargs: ignored for LocalCKAN (requests not used)
+        :param stream: True to return an iterator over the elements of a
+                       list result, or a key name like 'records' to iterate
+                       over that list within the result, for compatibility
+                       with RemoteCKAN
+        :param copy_dicts: False to pass data_dict and context to the
+                           action without copying them first. Actions may
+                           modify these dicts, so only use this when they
+                           won't be used again. A copy of self.context is
+                           still made when context is not passed
         """
         # copy dicts because actions may modify the dicts they are passed
         # (CKAN...you so crazy)
-        data_dict = dict(data_dict or [])
-        context = dict(self.context if context is None else context)
+        if copy_dicts:
+            data_dict = dict(data_dict or [])
+            context = dict(self.context if context is None else context)
+        else:
+            if data_dict is None:
+                data_dict = {}
+            if context is None:
+                context = dict(self.context)
         if apikey:
             # FIXME: allow use of apikey to set a user in context?
             raise CKANAPIError("LocalCKAN.call_action does not support "
@@ -71,11 +106,61 @@ class LocalCKAN(object):
                 file_storage.filename = filename
                 data_dict[fieldname] = file_storage
 
-            return self._get_action(action)(context, data_dict)
+            result = self._action_function(action)(context, data_dict)
+            if stream:
+                return iter(result if stream is True else result[stream])
+            return result
         finally:
             for f in to_close:
                 f.close()
 
+    def call_actions(self, calls, context=None, transaction=False):
+        """
+        Call many actions in order.
+
+        :param calls: list of (action name, data_dict) tuples
+        :param context: an override for the context to use for the
+                        actions, copied for each call
+        :param transaction: True to commit the changes made by all the
+                            actions together. The first exception raised
+                            rolls back every change and is re-raised
+
+        Returns a list with the result of each call in the same order,
+        or the exception raised by a call in place of its result.
+        """
+        context = dict(self.context if context is None else context)
+        if not transaction:
+            results = []
+            for action, data_dict in calls:
+                try:
+                    results.append(self.call_action(
+                        action, data_dict, context=context))
+                except Exception as e:
+                    results.append(e)
+            return results
+
+        from ckan import model
+        context['defer_commit'] = True
+        try:
+            results = [
+                self.call_action(action, data_dict, context=context)
+                for action, data_dict in calls]
+        except Exception:
+            model.repo.rollback()
+            raise
+        model.repo.commit()
+        return results
+
+    def iter_action(self, action, data_dict=None, requests_kwargs=None,
+            keyset=False):
+        """
+        Generator yielding every record from a paginated list or search
+        action. See ckanapi.common.iter_action.
+        """
+        # no prefetch: actions use the thread-local database session
+        return iter_action(self, action, data_dict, keyset=keyset,
+            prefetch=False)
+
 
 def _write_temp_file(f):
     """
@@ -1,11 +1,23 @@
 from urllib.request import Request, urlopen, HTTPError
 from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 
 from ckanapi.errors import CKANAPIError
 from ckanapi.common import (ActionShortcut, prepare_action,
-    reverse_apicontroller_action, REQUEST_TIMEOUT)
+    reverse_apicontroller_action, iter_action_result, iter_action,
+    REQUEST_TIMEOUT,
+    STREAM_CHUNK_SIZE, TokenBucket, is_read_only_action)
 from ckanapi.version import __version__
+import gzip
 import os
+import socket
+import threading
+import time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # add your sites to remove parallel limits on ckanapi cli
 MY_SITES = ['localhost', '127.0.0.1', '[::1]']
@@ -15,9 +27,21 @@ if CKANAPI_MY_SITES:
     MY_SITES.extend(additional_sites)
 
 # add your site above instead of changing this
-PARALLEL_LIMIT = os.getenv('CKANAPI_PARALLEL_LIMIT', default = 3)
+PARALLEL_LIMIT = int(os.getenv('CKANAPI_PARALLEL_LIMIT', default=3))
+
+# default requests in flight for call_actions, matches the default
+# connection pool size
+CALL_ACTIONS_WORKERS = 10
+# default connections kept open to the site, connections opened beyond
+# this number are closed after each request
+POOL_MAXSIZE = 10
+# default seconds a connection is idle before TCP keep-alive probes
+KEEPALIVE_IDLE = 60
+# request bodies smaller than this many bytes are sent uncompressed
+COMPRESS_MIN_SIZE = 16384
 
 import requests
+from urllib3.connection import HTTPConnection
 
 
 class RemoteCKAN(object):
@@ -31,15 +55,59 @@ class RemoteCKAN(object):
     :param user_agent: the User-agent to report when making requests
     :param get_only: only use GET requests (default: False)
     :param session: session to use (default: None)
+    :param retry: RetryPolicy used to retry requests that fail with a
+                  connection error or temporary server error
+                  (default: None, no retries)
+    :param rate_limit: maximum requests per second made by this instance,
+                       including retries (default: None, no limit)
+    :param cache: ActionCache such as MemoryCache or SQLiteCache for
+                  responses to read-only actions (default: None)
+    :param pool_maxsize: connections kept open for reuse, set to the
+                         number of threads making requests to avoid new
+                         connections and TLS handshakes
+                         (default: POOL_MAXSIZE)
+    :param pool_connections: number of hosts to keep connections open
+                             for (default: 1)
+    :param keepalive: seconds a connection is idle before TCP keep-alive
+                      probes are sent, None to disable
+                      (default: KEEPALIVE_IDLE)
+
+    :param compress: 'gzip' or 'br' to compress JSON request bodies, the
+                     site must accept compressed request bodies
+                     (default: None)
+    :param compress_min_size: smallest request body in bytes to compress
+                              (default: COMPRESS_MIN_SIZE)
+
+    pool_maxsize, pool_connections and keepalive apply to the session
+    created by open_session() when session is not passed.
     """
 
     base_url = 'api/action/'
 
-    def __init__(self, address, apikey=None, user_agent=None, get_only=False, session=None):
+    def __init__(self, address, apikey=None, user_agent=None, get_only=False,
+            session=None, retry=None, rate_limit=None, cache=None,
+            pool_maxsize=POOL_MAXSIZE, pool_connections=1,
+            keepalive=KEEPALIVE_IDLE, compress=None,
+            compress_min_size=COMPRESS_MIN_SIZE):
+        if compress not in (None, 'gzip', 'br'):
+            raise CKANAPIError("RemoteCKAN: compress must be 'gzip' or 'br'")
+        if compress == 'br' and not brotli:
+            raise CKANAPIError("RemoteCKAN: the brotli package is required "
+                "for compress='br'")
         self.address = address
         self.apikey = apikey
         self.get_only = get_only
         self.session = session
+        self._session_lock = threading.Lock()
+        self.retry = retry
+        self.rate_limit = rate_limit
+        self._bucket = TokenBucket(rate_limit) if rate_limit else None
+        self.cache = cache
+        self.pool_maxsize = pool_maxsize
+        self.pool_connections = pool_connections
+        self.keepalive = keepalive
+        self.compress = compress
+        self.compress_min_size = compress_min_size
         if not user_agent:
             user_agent = "ckanapi/{version} (+{url})".format(
                 version=__version__,
@@ -47,7 +115,7 @@ class RemoteCKAN(object):
         self.user_agent = user_agent
         self.action = ActionShortcut(self)
 
-        net_loc = urlparse(address)
+        net_loc = urlparse(address).netloc
         if ']' in net_loc:
             net_loc = net_loc[:net_loc.index(']') + 1]
         elif ':' in net_loc:
@@ -57,7 +125,7 @@ class RemoteCKAN(object):
             self.parallel_limit = PARALLEL_LIMIT
 
     def call_action(self, action, data_dict=None, context=None, apikey=None,
-            files=None, requests_kwargs=None):
+            files=None, requests_kwargs=None, stream=False):
         """
         :param action: the action name, e.g. 'package_create'
         :param data_dict: the dict to pass to the action as JSON,
@@ -66,6 +134,10 @@ class RemoteCKAN(object):
         :param apikey: API key for authentication
         :param files: None or {field-name: file-to-be-sent, ...}
         :param requests_kwargs: kwargs for requests get/post calls
+        :param stream: True to return an iterator over the elements of a
+                       list result as they are received instead of the
+                       whole result, or a key name like 'records' to
+                       iterate over that list within the result
 
         This function parses the response from the server as JSON and
         returns the decoded value.  When an error is returned this
@@ -82,16 +154,164 @@ class RemoteCKAN(object):
             action, data_dict, apikey or self.apikey, files,
             base_url=self.base_url)
         headers['User-Agent'] = self.user_agent
+        if (self.compress and not files and not self.get_only
+                and len(data) >= self.compress_min_size):
+            data = _compress(data, self.compress)
+            headers['Content-Encoding'] = self.compress
         url = self.address.rstrip('/') + '/' + url
-        requests_kwargs = requests_kwargs or {}
+        requests_kwargs = dict(requests_kwargs or {})
         requests_kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+        if stream:
+            requests_kwargs['stream'] = True
+        cache = self.cache
+        if stream or files or not is_read_only_action(action):
+            cache = None
+        entry = None
+        if cache:
+            key = cache.key(action, data_dict, apikey or self.apikey)
+            entry = cache.get(key)
+            if entry and entry['expires'] > time.time():
+                return reverse_apicontroller_action(
+                    url, entry['status'], entry['text'])
+            if entry and entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry and entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        self.open_session()
+        r = self._request_with_retry(action, url, data, data_dict, headers,
+            files, requests_kwargs)
+        if stream:
+            return self._iter_response(url, r, stream)
+        if cache and r.status_code == 304 and entry:
+            entry['expires'] = time.time() + cache.ttl_for(action)
+            cache.set(key, entry)
+            return reverse_apicontroller_action(
+                url, entry['status'], entry['text'])
+        if cache and r.status_code == 200:
+            cache.set(key, cache.new_entry(action, r))
+        return reverse_apicontroller_action(url, r.status_code, r.text)
+
+    def call_actions(self, calls, apikey=None, requests_kwargs=None,
+            max_workers=None):
+        """
+        Call many actions concurrently over this instance's connection
+        pool.
+
+        :param calls: list of (action name, data_dict) tuples
+        :param apikey: API key for authentication
+        :param requests_kwargs: kwargs for requests get/post calls
+        :param max_workers: maximum number of requests in flight, defaults
+                            to parallel_limit or CALL_ACTIONS_WORKERS
+
+        Returns a list with the result of each call in the same order,
+        or the exception raised by a call in place of its result.
+        """
+        calls = list(calls)
+        if not calls:
+            return []
+        if max_workers is None:
+            max_workers = getattr(self, 'parallel_limit', CALL_ACTIONS_WORKERS)
+        self.open_session()
+
+        def call(action_data_dict):
+            try:
+                return self.call_action(*action_data_dict, apikey=apikey,
+                    requests_kwargs=requests_kwargs)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(min(max_workers, len(calls))) as executor:
+            return list(executor.map(call, calls))
+
+    def iter_action(self, action, data_dict=None, requests_kwargs=None,
+            keyset=False):
+        """
+        Generator yielding every record from a paginated list or search
+        action, requesting the next page on a background thread while
+        the current page is consumed. See ckanapi.common.iter_action.
+        """
+        return iter_action(self, action, data_dict,
+            requests_kwargs=requests_kwargs, keyset=keyset)
+
+    def _iter_response(self, url, r, stream):
+        """
+        generator for call_action stream results, closes the response
+        when done
+        """
+        try:
+            if r.status_code != 200:
+                # errors are small, parse them the usual way
+                result = reverse_apicontroller_action(
+                    url, r.status_code, r.text)
+                for value in result if stream is True else result[stream]:
+                    yield value
+                return
+            for value in iter_action_result(url, r.status_code,
+                    r.iter_content(chunk_size=STREAM_CHUNK_SIZE),
+                    None if stream is True else stream):
+                yield value
+        finally:
+            r.close()
+
+    def open_session(self):
+        """
+        return self.session, creating a session with the connection pool
+        and keep-alive settings first if there isn't one. Safe to call
+        from many threads, they will all share one session.
+        """
         if not self.session:
-            self.session = requests.Session()
-        if self.get_only:
-            status, response = self._request_fn_get(url, data_dict, headers, requests_kwargs)
-        else:
-            status, response = self._request_fn(url, data, headers, files, requests_kwargs)
-        return reverse_apicontroller_action(url, status, response)
+            with self._session_lock:
+                if not self.session:
+                    self.session = self._new_session()
+        return self.session
+
+    def _new_session(self):
+        """
+        return a session with connection pool and keep-alive settings
+        """
+        session = requests.Session()
+        adapter = _PoolAdapter(
+            socket_options=_keepalive_socket_options(self.keepalive),
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _request_with_retry(self, action, url, data, data_dict, headers,
+            files, requests_kwargs):
+        """
+        make the request, retrying as allowed by self.retry
+        """
+        retry = self.retry
+        positions = _file_positions(files) if retry else None
+        if files and positions is None:
+            retry = None  # can't send these files again
+        attempt = 0
+        while True:
+            retry_after = None
+            if self._bucket:
+                self._bucket.acquire()
+            try:
+                if self.get_only:
+                    r = self._request_fn_get(
+                        url, data_dict, headers, requests_kwargs)
+                else:
+                    r = self._request_fn(
+                        url, data, headers, files, requests_kwargs)
+                if not retry or not retry.should_retry(
+                        action, attempt, r.status_code):
+                    return r
+                retry_after = r.headers.get('Retry-After')
+                r.close()
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout):
+                if not retry or not retry.should_retry(action, attempt):
+                    raise
+            time.sleep(retry.delay(attempt, retry_after))
+            for f, pos in positions or ():
+                f.seek(pos)
+            attempt += 1
 
     def _request_fn(self, url, data, headers, files, requests_kwargs):
         r = self.session.post(url, data=data, headers=headers, files=files,
@@ -101,12 +321,12 @@ class RemoteCKAN(object):
         # new URL, but *without* the data. This gives a confusing "No request
         # body data" error. It is better to just return the 301 to the user, so
         # we disallow redirects.
-        return r.status_code, r.text
+        return r
 
     def _request_fn_get(self, url, data_dict, headers, requests_kwargs):
         r = self.session.get(url, params=data_dict, headers=headers,
             **requests_kwargs)
-        return r.status_code, r.text
+        return r
 
     def close(self):
         """Close session"""
@@ -119,3 +339,63 @@ class RemoteCKAN(object):
 
     def __exit__(self, *args):
         self.close()
+
+
+def _file_positions(files):
+    """
+    return [(file, position), ...] for files to be sent so they can be
+    sent again, or None if some can't be rewound
+    """
+    positions = []
+    for f in (files or {}).values():
+        if isinstance(f, tuple):
+            f = f[1]
+        if not hasattr(f, 'read'):
+            continue  # str or bytes content
+        try:
+            positions.append((f, f.tell()))
+        except (AttributeError, IOError):
+            return None
+    return positions
+
+
+def _compress(data, encoding):
+    """
+    return request body data compressed with encoding 'gzip' or 'br'
+    """
+    if encoding == 'br':
+        return brotli.compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+class _PoolAdapter(requests.adapters.HTTPAdapter):
+    """
+    HTTPAdapter that sets socket options on new connections
+    """
+    def __init__(self, socket_options=None, **kwargs):
+        # set before HTTPAdapter.__init__ calls init_poolmanager
+        self.socket_options = socket_options
+        super(_PoolAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.socket_options:
+            kwargs['socket_options'] = self.socket_options
+        super(_PoolAdapter, self).init_poolmanager(*args, **kwargs)
+
+
+def _keepalive_socket_options(idle):
+    """
+    return urllib3 socket options enabling TCP keep-alive probes after
+    idle seconds, or None
+    """
+    if not idle:
+        return None
+    options = list(HTTPConnection.default_socket_options) + [
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        options += [
+            (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle),
+            (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, idle // 4))]
+    elif hasattr(socket, 'TCP_KEEPALIVE'):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle))
+    return options
@@ -1,5 +1,6 @@
 import json
 import csv
+import gzip
 from io import StringIO
 from werkzeug.formparser import parse_form_data
 from wsgiref.simple_server import make_server
@@ -20,6 +21,16 @@ def mock_ckan(environ, start_response):
             "success": True,
             "result": ["aa", "bb", "cc"]
             }).encode('utf-8')]
+    if environ['PATH_INFO'] == '/api/action/datastore_search':
+        start_response(status, headers)
+        return [json.dumps({
+            "help": "none",
+            "success": True,
+            "result": {
+                "fields": [{"id": "_id", "type": "int"}],
+                "records": [{"_id": i} for i in range(1, 1001)],
+                },
+            }).encode('utf-8')]
     if environ['PATH_INFO'] == '/api/action/test_echo_user_agent':
         start_response(status, headers)
         return [json.dumps({
@@ -34,6 +45,24 @@ def mock_ckan(environ, start_response):
             "success": True,
             "result": environ['CONTENT_TYPE']
             }).encode('utf-8')]
+    if environ['PATH_INFO'] == '/api/action/test_echo_encoding':
+        body = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))
+        if environ.get('HTTP_CONTENT_ENCODING') == 'gzip':
+            body = gzip.decompress(body)
+        response = json.dumps({
+            "help": "none",
+            "success": True,
+            "result": {
+                'content_encoding': environ.get('HTTP_CONTENT_ENCODING'),
+                'accept_encoding': environ.get('HTTP_ACCEPT_ENCODING'),
+                'data_dict': json.loads(body.decode('utf-8')),
+                },
+            }).encode('utf-8')
+        if 'gzip' in environ.get('HTTP_ACCEPT_ENCODING', ''):
+            response = gzip.compress(response)
+            headers.append(('Content-Encoding', 'gzip'))
+        start_response(status, headers)
+        return [response]
     if environ['PATH_INFO'] == '/api/action/test_upload':
         _, form, files = parse_form_data(environ)
         upload_data = files['upload'].stream.read().decode('utf-8').splitlines()
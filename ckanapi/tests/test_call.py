@@ -13,6 +13,46 @@ class TestCallAction(unittest.TestCase):
             ckanapi.LocalCKAN('fake').call_action,
             'fake', {}, {}, 'apikey not allowed')
 
+    def test_local_action_cache(self):
+        calls = []
+        def fake_action(context, data_dict):
+            calls.append((context, data_dict))
+            data_dict['changed'] = True
+            return 'ok'
+        def fake_get_action(name):
+            # like ckan.logic.get_action, fills CKAN's own action cache
+            lookups.append(name)
+            logic._actions[name] = lambda c, d: fake_action(c, d)
+            return logic._actions[name]
+        class logic(object):
+            _actions = {}
+        lookups = []
+        local = ckanapi.LocalCKAN.__new__(ckanapi.LocalCKAN)
+        local._logic = logic
+        local._get_action = fake_get_action
+        local._actions = {}
+        local.context = {'user': 'fake'}
+
+        data_dict = {'id': 'a'}
+        self.assertEqual(local.call_action('package_show', data_dict), 'ok')
+        self.assertEqual(data_dict, {'id': 'a'})
+        self.assertEqual(local.call_action('package_show', data_dict,
+            copy_dicts=False), 'ok')
+        self.assertEqual(data_dict, {'id': 'a', 'changed': True})
+        self.assertEqual(calls[1][0], {'user': 'fake'})
+        self.assertEqual(lookups, ['package_show'])
+
+        # CKAN clears its action cache when plugins change
+        logic._actions.clear()
+        local.call_action('package_show')
+        self.assertEqual(lookups, ['package_show', 'package_show'])
+        local.call_action('package_show')
+        self.assertEqual(lookups, ['package_show', 'package_show'])
+
+        local.clear_action_cache()
+        local.call_action('package_show')
+        self.assertEqual(len(lookups), 3)
+
     def test_remote_fail(self):
         self.assertRaises(
             ckanapi.CKANAPIError,
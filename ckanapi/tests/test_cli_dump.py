@@ -1,4 +1,8 @@
-from ckanapi.cli.dump import dump_things, dump_things_worker
+from ckanapi.cli.dump import (dump_things, dump_things_worker,
+    populate_resources)
+from ckanapi import RemoteCKAN
+from ckanapi.cli.workers import frame, unframe
+from ckanapi.cli.utils import compact_json
 from ckanapi.errors import NotFound
 import json
 import tempfile
@@ -6,6 +10,7 @@ import shutil
 from os.path import exists
 
 import unittest
+import unittest.mock
 from io import BytesIO
 
 
@@ -61,6 +66,144 @@ class MockCKAN(object):
             raise NotFound()
 
 
+class MockSearchCKAN(object):
+    datasets = [
+        {'id': '1', 'name': 'one', 'num_resources': 0, 'resources': []},
+        {'id': '2', 'name': 'two', 'num_resources': 1, 'resources': []},
+        {'id': '3', 'name': 'three', 'num_resources': 0, 'resources': []},
+        ]
+
+    def __init__(self):
+        self.calls = []
+
+    def call_action(self, name, data_dict, requests_kwargs=None):
+        self.calls.append((name, data_dict))
+        if name == 'package_search':
+            start, rows = data_dict['start'], data_dict['rows']
+            return {
+                'count': len(self.datasets),
+                'results': self.datasets[start:start + rows]}
+        if name == 'package_show' and data_dict['id'] == '2':
+            return {'id': '2', 'name': 'two', 'num_resources': 1,
+                'resources': [{'id': 'r'}]}
+        raise NotFound()
+
+
+class MockStateCKAN(MockCKAN):
+    def call_action(self, name, data_dict, requests_kwargs=None):
+        if name == 'package_search':
+            return {'count': 3, 'results': [
+                {'metadata_modified': '2026-02-01T00:00:00'}]}
+        return super(MockStateCKAN, self).call_action(name, data_dict)
+
+
+class MockRemoteSearchCKAN(RemoteCKAN):
+    def __init__(self):
+        super(MockRemoteSearchCKAN, self).__init__('http://localhost')
+        self.search = MockSearchCKAN()
+
+    def call_action(self, name, data_dict, requests_kwargs=None):
+        return self.search.call_action(name, data_dict)
+
+
+class MockIncrementalCKAN(object):
+    changed = [
+        {'id': '2', 'name': 'bb', 'state': 'deleted',
+            'resources': [{'id': 'r', 'datastore_active': True}],
+            'metadata_modified': '2026-02-01T00:00:00.000001'},
+        {'id': '3', 'name': 'cc', 'state': 'active', 'resources': [],
+            'metadata_modified': '2026-02-01T00:00:00.000002'},
+        {'id': '5', 'name': 'dd', 'state': 'active', 'resources': [],
+            'metadata_modified': '2026-02-01T00:00:00.000003'},
+        ]
+
+    def __init__(self):
+        self.calls = []
+
+    def call_action(self, name, data_dict, requests_kwargs=None):
+        self.calls.append((name, data_dict))
+        if data_dict.get('sort') == 'metadata_modified desc':
+            return {'count': 3, 'results': self.changed[-1:]}
+        if data_dict.get('start'):
+            return {'count': 3, 'results': []}
+        return {'count': 3, 'results': self.changed}
+
+
+class MockRemoteCKAN(RemoteCKAN):
+    def __init__(self):
+        super(MockRemoteCKAN, self).__init__('http://localhost')
+        self.batches = []
+        self.max_workers = []
+        self.requests_kwargs = []
+
+    def call_action(self, name, data_dict, requests_kwargs=None):
+        self.requests_kwargs.append(requests_kwargs)
+        return MockCKAN().call_action(name, data_dict)
+
+    def call_actions(self, calls, apikey=None, requests_kwargs=None,
+            max_workers=None):
+        self.batches.append(calls)
+        self.max_workers.append(max_workers)
+        results = []
+        for action, data_dict in calls:
+            try:
+                results.append(MockCKAN().call_action(action, data_dict))
+            except Exception as e:
+                results.append(e)
+        return results
+
+
+class TestPopulateResources(unittest.TestCase):
+    def _resources(self):
+        return [
+            {'id': 'd902fafc-5717-4dd0-87f2-7a6fc96989b7',
+             'datastore_active': True},
+            {'id': 'missing', 'datastore_active': True},
+            {'id': 'not-in-datastore', 'datastore_active': False},
+            ]
+
+    def test_batched(self):
+        ckan = MockRemoteCKAN()
+        resources = self._resources()
+        populate_resources(ckan, resources, datastore_fields=True,
+            views=True)
+        self.assertEqual(len(ckan.batches), 1)
+        self.assertEqual([c[0] for c in ckan.batches[0]], [
+            'datastore_search', 'resource_view_list',
+            'datastore_search', 'resource_view_list',
+            'resource_view_list'])
+        self.assertEqual(resources[0]['datastore_fields'][0]['id'], 'col1')
+        self.assertEqual(len(resources[0]['resource_views']), 1)
+        self.assertEqual(resources[1:], self._resources()[1:])
+
+    def test_parallel_limit(self):
+        ckan = MockRemoteCKAN()
+        ckan.parallel_limit = 3
+        resources = self._resources()
+        populate_resources(ckan, resources, datastore_fields=True)
+        self.assertEqual(ckan.batches, [])
+        self.assertEqual(resources[0]['datastore_fields'][0]['id'], 'col1')
+
+    def test_pool_maxsize(self):
+        ckan = MockRemoteCKAN()
+        ckan.pool_maxsize = 2
+        populate_resources(ckan, self._resources(), datastore_fields=True)
+        self.assertEqual(ckan.max_workers, [2])
+
+    def test_not_concurrent(self):
+        ckan = MockRemoteCKAN()
+        populate_resources(ckan, self._resources(), datastore_fields=True,
+            requests_kwargs={'verify': False}, concurrent=False)
+        self.assertEqual(ckan.batches, [])
+        self.assertEqual(ckan.requests_kwargs, [{'verify': False}] * 2)
+
+    def test_not_remote(self):
+        resources = self._resources()
+        populate_resources(MockCKAN(), resources, datastore_fields=True)
+        self.assertEqual(resources[0]['datastore_fields'][0]['id'], 'col1')
+        self.assertNotIn('resource_views', resources[0])
+
+
 class TestCLIDump(unittest.TestCase):
     def setUp(self):
         self.ckan = MockCKAN()
@@ -73,10 +216,9 @@ class TestCLIDump(unittest.TestCase):
              '--resource-views': False,
              '--insecure': False},
             stdin=BytesIO(b'"34"\n'), stdout=self.stdout)
-        response = self.stdout.getvalue()
-        self.assertEqual(response[-1:], b'\n')
-        timstamp, error, data = json.loads(response.decode('UTF-8'))
+        (timstamp, error, name), data = _read_frames(self.stdout)[0]
         self.assertEqual(error, None)
+        self.assertEqual(name, "thirtyfour")
         self.assertEqual(data["title"], "Thirty-four")
 
     def test_worker_two(self):
@@ -85,14 +227,11 @@ class TestCLIDump(unittest.TestCase):
              '--resource-views': False,
              '--insecure': False},
             stdin=BytesIO(b'"12"\n"34"\n'), stdout=self.stdout)
-        response = self.stdout.getvalue()
-        self.assertEqual(response.count(b'\n'), 2, response)
-        self.assertEqual(response[-1:], b'\n')
-        r1, r2 = response.split(b'\n', 1)
-        timstamp, error, data = json.loads(r1.decode('UTF-8'))
+        r1, r2 = _read_frames(self.stdout)
+        (timstamp, error, name), data = r1
         self.assertEqual(error, None)
         self.assertEqual(data["title"], "Twelve")
-        timstamp, error, data = json.loads(r2.decode('UTF-8'))
+        (timstamp, error, name), data = r2
         self.assertEqual(error, None)
         self.assertEqual(data["title"], "Thirty-four")
 
@@ -100,9 +239,7 @@ class TestCLIDump(unittest.TestCase):
         dump_things_worker(self.ckan, 'datasets',
             {'--insecure': False},
             stdin=BytesIO(b'"99"\n'), stdout=self.stdout)
-        response = self.stdout.getvalue()
-        self.assertEqual(response[-1:], b'\n')
-        timstamp, error, data = json.loads(response.decode('UTF-8'))
+        [((timstamp, error, name), data)] = _read_frames(self.stdout)
         self.assertEqual(error, "NotFound")
         self.assertEqual(data, None)
 
@@ -110,9 +247,7 @@ class TestCLIDump(unittest.TestCase):
         dump_things_worker(self.ckan, 'groups',
             {'--insecure': False},
             stdin=BytesIO(b'"ab"\n'), stdout=self.stdout)
-        response = self.stdout.getvalue()
-        self.assertEqual(response[-1:], b'\n')
-        timstamp, error, data = json.loads(response.decode('UTF-8'))
+        [((timstamp, error, name), data)] = _read_frames(self.stdout)
         self.assertEqual(error, None)
         self.assertEqual(data, {"title":"ABBA"})
 
@@ -120,9 +255,7 @@ class TestCLIDump(unittest.TestCase):
         dump_things_worker(self.ckan, 'organizations',
             {'--insecure': False},
             stdin=BytesIO(b'"cd"\n'), stdout=self.stdout)
-        response = self.stdout.getvalue()
-        self.assertEqual(response[-1:], b'\n')
-        timstamp, error, data = json.loads(response.decode('UTF-8'))
+        [((timstamp, error, name), data)] = _read_frames(self.stdout)
         self.assertEqual(error, None)
         self.assertEqual(data, {"title":"Super Trouper"})
 
@@ -245,12 +378,248 @@ class TestCLIDump(unittest.TestCase):
             'ckanapi', 'dump', 'organizations', '--worker',
             'value-here-to-make-docopt-happy'])
         self.assertEqual(self.worker_processes, 1)
+        self.assertEqual(self.worker_kwargs, {'framed': True, 'window': 1000})
         self.assertEqual(self.stdout.getvalue(),
             b'{"id":"P"}\n'
             b'{"id":"Q"}\n'
             b'{"id":"R"}\n'
             b'{"id":"S"}\n')
 
+    def test_parent_unordered(self):
+        dump_things(self.ckan, 'organizations', {
+                '--quiet': True,
+                '--ckan-user': None,
+                '--config': None,
+                '--remote': None,
+                '--apikey': None,
+                '--worker': False,
+                '--log': None,
+                '--output': None,
+                '--datapackages': None,
+                '--gzip': False,
+                '--all': False,
+                'ID_OR_NAME': ['P', 'Q', 'R', 'S'],
+                '--processes': '1',
+                '--unordered': True,
+                '--get-request': False,
+                '--datastore-fields': False,
+                '--resource-views': False,
+                '--insecure': False,
+                '--include-users': False,
+            },
+            worker_pool=self._mock_worker_pool_reversed,
+            stdout=self.stdout,
+            stderr=self.stderr)
+        self.assertEqual(self.worker_kwargs, {'framed': True})
+        self.assertEqual(self.stdout.getvalue(),
+            b'{"id":"S"}\n'
+            b'{"id":"R"}\n'
+            b'{"id":"Q"}\n'
+            b'{"id":"P"}\n')
+
+    def test_parent_threads(self):
+        dump_things(self.ckan, 'datasets', {
+                '--quiet': True,
+                '--ckan-user': None,
+                '--config': None,
+                '--remote': None,
+                '--apikey': None,
+                '--worker': False,
+                '--log': None,
+                '--output': None,
+                '--datapackages': None,
+                '--gzip': False,
+                '--all': False,
+                'ID_OR_NAME': ['12', '34', '99'],
+                '--processes': '1',
+                '--threads': '3',
+                '--get-request': False,
+                '--datastore-fields': False,
+                '--resource-views': False,
+                '--insecure': False,
+                '--include-users': False,
+            },
+            stdout=self.stdout,
+            stderr=self.stderr)
+        self.assertEqual(self.stdout.getvalue(),
+            b'{"id":"12","name":"twelve","title":"Twelve"}\n'
+            b'{"id":"34","name":"thirtyfour","title":"Thirty-four"}\n')
+
+    def test_parent_via_search(self):
+        ckan = MockSearchCKAN()
+        with unittest.mock.patch('ckanapi.cli.search.ROWS_PER_QUERY', 2):
+            dump_things(ckan, 'datasets', {
+                    '--quiet': True,
+                    '--ckan-user': None,
+                    '--config': None,
+                    '--remote': None,
+                    '--apikey': None,
+                    '--worker': False,
+                    '--log': None,
+                    '--output': None,
+                    '--datapackages': None,
+                    '--gzip': False,
+                    '--all': True,
+                    '--via-search': True,
+                    '--include-private': True,
+                    '--processes': '1',
+                    '--get-request': False,
+                    '--datastore-fields': False,
+                    '--resource-views': False,
+                    '--insecure': False,
+                    '--include-users': False,
+                },
+                stdout=self.stdout,
+                stderr=self.stderr)
+        self.assertEqual([c[0] for c in ckan.calls], [
+            'package_search', 'package_show', 'package_search'])
+        self.assertEqual(ckan.calls[0][1]['include_private'], True)
+        self.assertEqual(ckan.calls[0][1]['sort'], 'name asc')
+        self.assertEqual(self.stdout.getvalue(),
+            b'{"id":"1","name":"one","num_resources":0,"resources":[]}\n'
+            b'{"id":"2","name":"two","num_resources":1,'
+            b'"resources":[{"id":"r"}]}\n'
+            b'{"id":"3","name":"three","num_resources":0,"resources":[]}\n')
+
+    def test_parent_via_search_threads(self):
+        ckan = MockRemoteSearchCKAN()
+        with unittest.mock.patch('ckanapi.cli.search.ROWS_PER_QUERY', 2):
+            dump_things(ckan, 'datasets', {
+                    '--quiet': True,
+                    '--ckan-user': None,
+                    '--config': None,
+                    '--remote': None,
+                    '--apikey': None,
+                    '--worker': False,
+                    '--log': None,
+                    '--output': None,
+                    '--datapackages': None,
+                    '--gzip': False,
+                    '--all': True,
+                    '--via-search': True,
+                    '--processes': '1',
+                    '--threads': '3',
+                    '--get-request': False,
+                    '--datastore-fields': False,
+                    '--resource-views': False,
+                    '--insecure': False,
+                    '--include-users': False,
+                },
+                stdout=self.stdout,
+                stderr=self.stderr)
+        self.assertEqual(self.stdout.getvalue(),
+            b'{"id":"1","name":"one","num_resources":0,"resources":[]}\n'
+            b'{"id":"2","name":"two","num_resources":1,'
+            b'"resources":[{"id":"r"}]}\n'
+            b'{"id":"3","name":"three","num_resources":0,"resources":[]}\n')
+
+    def test_parent_via_search_requires_all(self):
+        rval = dump_things(self.ckan, 'groups', {
+                '--worker': False,
+                '--all': True,
+                '--via-search': True,
+            },
+            stdout=self.stdout,
+            stderr=self.stderr)
+        self.assertEqual(rval, 1)
+
+    def test_parent_state_file(self):
+        target = tempfile.mkdtemp()
+        try:
+            with open(target + '/out.jsonl', 'wb') as f:
+                f.write(
+                    b'{"id":"1","name":"aa"}\n'
+                    b'{"id":"2","name":"bb"}\n'
+                    b'{"id":"3","name":"c-old"}\n'
+                    b'{"id":"4","name":"ee"}\n')
+            with open(target + '/state.json', 'wb') as f:
+                f.write(b'{"metadata_modified":"2026-01-01T00:00:00.123"}')
+            ckan = MockIncrementalCKAN()
+            dump_things(ckan, 'datasets', {
+                    '--quiet': True,
+                    '--ckan-user': None,
+                    '--config': None,
+                    '--remote': None,
+                    '--apikey': None,
+                    '--worker': False,
+                    '--log': None,
+                    '--output': target + '/out.jsonl',
+                    '--state-file': target + '/state.json',
+                    '--datapackages': None,
+                    '--gzip': False,
+                    '--all': True,
+                    '--processes': '1',
+                    '--get-request': False,
+                    '--datastore-fields': True,
+                    '--resource-views': False,
+                    '--insecure': False,
+                    '--include-users': False,
+                },
+                stdout=self.stdout,
+                stderr=self.stderr)
+            self.assertEqual(ckan.calls[1][1]['fq'],
+                'metadata_modified:[2026-01-01T00:00:00Z TO *]')
+            # deleted datasets are removed, not populated
+            self.assertEqual([c[0] for c in ckan.calls],
+                ['package_search', 'package_search'])
+            with open(target + '/out.jsonl', 'rb') as f:
+                self.assertEqual(f.read(),
+                    b'{"id":"1","name":"aa"}\n'
+                    b'{"id":"3","metadata_modified":'
+                    b'"2026-02-01T00:00:00.000002","name":"cc",'
+                    b'"resources":[],"state":"active"}\n'
+                    b'{"id":"5","metadata_modified":'
+                    b'"2026-02-01T00:00:00.000003","name":"dd",'
+                    b'"resources":[],"state":"active"}\n'
+                    b'{"id":"4","name":"ee"}\n')
+            with open(target + '/state.json', 'rb') as f:
+                self.assertEqual(json.loads(f.read()), {
+                    'metadata_modified': '2026-02-01T00:00:00.000003',
+                    'deleted': ['2']})
+            self.assertEqual(self.stdout.getvalue(), b'')
+        finally:
+            shutil.rmtree(target)
+
+    def test_parent_state_file_output_missing(self):
+        target = tempfile.mkdtemp()
+        try:
+            with open(target + '/state.json', 'wb') as f:
+                f.write(b'{"metadata_modified":"2026-01-01T00:00:00.123"}')
+            dump_things(MockStateCKAN(), 'datasets', {
+                    '--quiet': True,
+                    '--ckan-user': None,
+                    '--config': None,
+                    '--remote': None,
+                    '--apikey': None,
+                    '--worker': False,
+                    '--log': None,
+                    '--output': target + '/out.jsonl',
+                    '--state-file': target + '/state.json',
+                    '--datapackages': None,
+                    '--gzip': False,
+                    '--all': True,
+                    '--processes': '1',
+                    '--get-request': False,
+                    '--datastore-fields': False,
+                    '--resource-views': False,
+                    '--insecure': False,
+                    '--include-users': False,
+                },
+                worker_pool=self._mock_worker_pool,
+                stdout=self.stdout,
+                stderr=self.stderr)
+            self.assertIn(b'dumping all datasets', self.stderr.getvalue())
+            self.assertEqual(self.worker_jobs,
+                [(0, b'"12"\n'), (1, b'"34"\n'), (2, b'"dp"\n')])
+            with open(target + '/out.jsonl', 'rb') as f:
+                self.assertEqual(len(f.read().splitlines()), 3)
+            with open(target + '/state.json', 'rb') as f:
+                self.assertEqual(json.loads(f.read()), {
+                    'metadata_modified': '2026-02-01T00:00:00',
+                    'deleted': []})
+        finally:
+            shutil.rmtree(target)
+
     def test_parent_datapackages(self):
         target = tempfile.mkdtemp()
         try:
@@ -427,20 +796,21 @@ class TestCLIDump(unittest.TestCase):
         self.assertEqual(data_dict["include_drafts"], True)
         self.assertEqual(data_dict["include_deleted"], True)
 
-    def _mock_worker_pool(self, cmd, processes, job_iter):
+    def _mock_worker_pool(self, cmd, processes, job_iter, **kwargs):
         self.worker_cmd = cmd
         self.worker_processes = processes
+        self.worker_kwargs = kwargs
         self.worker_jobs = list(job_iter)
         for i, j in self.worker_jobs:
             jname = json.loads(j.decode('UTF-8'))
-            yield [[], i, json.dumps(['some-date', None, {'id': jname}]
-                ).encode('UTF-8') + b'\n']
+            yield [[], i, frame(['some-date', None, None],
+                compact_json({'id': jname}, sort_keys=True))]
 
-    def _mock_worker_pool_reversed(self, cmd, processes, job_iter):
+    def _mock_worker_pool_reversed(self, cmd, processes, job_iter, **kwargs):
         return reversed(list(
-            self._mock_worker_pool(cmd, processes, job_iter)))
+            self._mock_worker_pool(cmd, processes, job_iter, **kwargs)))
 
-    def _worker_pool_with_data(self, cmd, processes, job_iter):
+    def _worker_pool_with_data(self, cmd, processes, job_iter, **kwargs):
         worker_stdin = BytesIO(b''.join(v for i, v in job_iter))
         worker_stdout = BytesIO()
         dump_things_worker(self.ckan, 'datasets', {
@@ -450,11 +820,11 @@ class TestCLIDump(unittest.TestCase):
             '--include-users': False,},
             stdin=worker_stdin,
             stdout=worker_stdout)
-        for i, v in enumerate(worker_stdout.getvalue().strip().split(b'\n')):
+        for i, v in enumerate(_split_frames(worker_stdout.getvalue())):
             yield [[], i, v]
 
 
-    def _worker_pool_with_resource_views(self, cmd, proccesses, job_iter):
+    def _worker_pool_with_resource_views(self, cmd, proccesses, job_iter, **kwargs):
         worker_stdin = BytesIO(b''.join(v for i, v in job_iter))
         worker_stdout = BytesIO()
         dump_things_worker(self.ckan, 'datasets', {
@@ -464,5 +834,29 @@ class TestCLIDump(unittest.TestCase):
             '--include-users': False,},
             stdin=worker_stdin,
             stdout=worker_stdout)
-        for i, v in enumerate(worker_stdout.getvalue().strip().split(b'\n')):
+        for i, v in enumerate(_split_frames(worker_stdout.getvalue())):
             yield [[], i, v]
+
+
+def _split_frames(data):
+    """
+    return the list of worker frames in data
+    """
+    frames = []
+    while data:
+        size, _sp, rest = data.partition(b' ')
+        end = data.index(b'\n') + 1 + int(size)
+        frames.append(data[:end])
+        data = data[end:]
+    return frames
+
+
+def _read_frames(stdout):
+    """
+    return [(meta, decoded record), ...] written by a dump worker
+    """
+    frames = []
+    for f in _split_frames(stdout.getvalue()):
+        meta, payload = unframe(f)
+        frames.append((meta, json.loads(payload) if payload else None))
+    return frames
@@ -23,6 +23,14 @@ class MockCKAN(object):
                     '12': {'title': "Twelve"},
                     '30ish': {'id': '34', 'title': "Thirty-four"},
                     '34': {'id': '34', 'title': "Thirty-four"},
+                    'same': {'id': 'same', 'name': 'same', 'title': "Same",
+                        'metadata_modified': '2026-01-01T00:00:00',
+                        'num_tags': 2, 'tags': [
+                            {'name': 'a', 'display_name': 'a'},
+                            {'name': 'b', 'display_name': 'b'}]},
+                    'nested': {'id': 'nested', 'name': 'nested',
+                        'resources': [{'id': 'r', 'position': 0,
+                            'layout': {'position': 'left'}}]},
                     },
                 'group_show': {
                     'ab': {'title': "ABBA"},
@@ -37,6 +45,7 @@ class MockCKAN(object):
                     },
                 'package_update': {
                     '34': {'name': 'something-updated'},
+                    'same': {'name': 'same'},
                     },
                 'group_update': {
                     'ab': {'name': 'group-updated'},
@@ -222,6 +231,102 @@ class TestCLILoad(unittest.TestCase):
         self.assertEqual(error, None)
         self.assertEqual(data, 'something-updated')
 
+    def test_update_unchanged(self):
+        load_things_worker(self.ckan, 'datasets', {
+                '--create-only': False,
+                '--update-only': False,
+                '--upload-resources': False,
+                '--insecure': False,
+                },
+            stdin=BytesIO(
+                b'{"id": "same", "name": "same", "title": "Same",'
+                b'"metadata_modified": "2025-01-01T00:00:00",'
+                b'"tags": [{"name": "b"}, {"name": "a"}]}\n'),
+            stdout=self.stdout)
+        response = self.stdout.getvalue()
+        self.assertEqual(response[-1:], b'\n')
+        timstamp, action, error, data = json.loads(response.decode('UTF-8'))
+        self.assertEqual(action, 'unchanged')
+        self.assertEqual(error, None)
+        self.assertEqual(data, 'same')
+
+    def test_update_unchanged_tags_from_other_site(self):
+        load_things_worker(self.ckan, 'datasets', {
+                '--create-only': False,
+                '--update-only': False,
+                '--upload-resources': False,
+                '--insecure': False,
+                },
+            stdin=BytesIO(
+                b'{"id": "same", "name": "same", "title": "Same",'
+                b'"tags": [{"name": "b", "id": "x", "state": "active"},'
+                b'{"name": "a", "id": "y", "vocabulary_id": null}]}\n'),
+            stdout=self.stdout)
+        response = self.stdout.getvalue()
+        timstamp, action, error, data = json.loads(response.decode('UTF-8'))
+        self.assertEqual(action, 'unchanged')
+
+    def test_update_unchanged_upload_resources(self):
+        load_things_worker(self.ckan, 'datasets', {
+                '--create-only': False,
+                '--update-only': False,
+                '--upload-resources': True,
+                '--insecure': False,
+                },
+            stdin=BytesIO(
+                b'{"id": "same", "name": "same", "title": "Same",'
+                b'"tags": [{"name": "b"}, {"name": "a"}]}\n'),
+            stdout=self.stdout)
+        response = self.stdout.getvalue()
+        timstamp, action, error, data = json.loads(response.decode('UTF-8'))
+        self.assertEqual(action, 'update')
+        self.assertEqual(error, None)
+
+    def test_update_changed(self):
+        load_things_worker(self.ckan, 'datasets', {
+                '--create-only': False,
+                '--update-only': False,
+                '--upload-resources': False,
+                '--insecure': False,
+                },
+            stdin=BytesIO(
+                b'{"id": "same", "name": "same", "title": "Different",'
+                b'"tags": [{"name": "b"}, {"name": "a"}]}\n'),
+            stdout=self.stdout)
+        response = self.stdout.getvalue()
+        timstamp, action, error, data = json.loads(response.decode('UTF-8'))
+        self.assertEqual(action, 'update')
+
+    def test_update_nested_position_changed(self):
+        load_things_worker(self.ckan, 'datasets', {
+                '--create-only': False,
+                '--update-only': False,
+                '--upload-resources': False,
+                '--insecure': False,
+                },
+            stdin=BytesIO(
+                b'{"id": "nested", "name": "nested", "resources": [{"id": "r",'
+                b'"layout": {"position": "right"}}]}\n'),
+            stdout=self.stdout)
+        response = self.stdout.getvalue()
+        timstamp, action, error, data = json.loads(response.decode('UTF-8'))
+        self.assertEqual(action, 'update')
+
+    def test_update_nested_position_unchanged(self):
+        load_things_worker(self.ckan, 'datasets', {
+                '--create-only': False,
+                '--update-only': False,
+                '--upload-resources': False,
+                '--insecure': False,
+                },
+            stdin=BytesIO(
+                b'{"id": "nested", "name": "nested", "resources": [{"id": "r",'
+                b'"layout": {"position": "left"}}]}\n'),
+            stdout=self.stdout)
+        response = self.stdout.getvalue()
+        timstamp, action, error, data = json.loads(response.decode('UTF-8'))
+        self.assertEqual(action, 'unchanged')
+
     def test_update_bad_option(self):
         load_things_worker(self.ckan, 'datasets', {
                 '--create-only': True,
@@ -430,9 +535,45 @@ class TestCLILoad(unittest.TestCase):
             'ckanapi', 'load', 'datasets', '--worker'])
         self.assertEqual(self.worker_processes, 2)
 
-    def _mock_worker_pool(self, cmd, processes, job_iter):
+    def test_parent_adaptive_parallel_limit(self):
+        self.ckan.parallel_limit = 2
+        load_things(self.ckan, 'datasets', {
+                '--quiet': False,
+                '--ckan-user': None,
+                '--config': None,
+                '--remote': None,
+                '--apikey': None,
+                '--worker': False,
+                '--log': None,
+                '--gzip': False,
+                '--processes': '5',
+                '--input': None,
+                '--create-only': False,
+                '--update-only': False,
+                '--start-record': '1',
+                '--max-records': None,
+                '--upload-resources': False,
+                '--upload-logo': False,
+                '--insecure': False,
+                '--adaptive': True,
+            },
+            worker_pool=self._mock_worker_pool,
+            stdin=BytesIO(
+                b'{"name": "cd", "title": "Go"}\n'
+                b'{"name": "ef", "title": "Play"}\n'
+                ),
+            stdout=self.stdout,
+            stderr=self.stderr)
+        self.assertEqual(self.worker_cmd, [
+            'ckanapi', 'load', 'datasets', '--worker'])
+        self.assertEqual(self.worker_processes, 5)
+        self.assertEqual(self.worker_limiter.maximum, 5)
+        self.assertEqual(self.worker_limiter.limit, 2)
+
+    def _mock_worker_pool(self, cmd, processes, job_iter, limiter=None):
         self.worker_cmd = cmd
         self.worker_processes = processes
+        self.worker_limiter = limiter
         self.worker_jobs = list(job_iter)
         for i, j in self.worker_jobs:
             jname = json.loads(j.decode('UTF-8'))
@@ -1,5 +1,7 @@
-from ckanapi.cli.workers import worker_pool
+from ckanapi.cli.workers import (worker_pool, ThreadWorker, AdaptiveLimiter,
+    frame, unframe, pool_options)
 import os
+import time
 
 import unittest
 
@@ -160,3 +162,264 @@ class TestCLIWorkers(unittest.TestCase):
         self.assertEqual(response, ([None, 2], 1, b'BB\n'))
         for c in children:
             c.close_pipes()
+
+    def test_pipeline(self):
+        children = []
+        def child_created(child):
+            child.stdout_write(b'AA\n')
+            children.append(child)
+        pool = worker_pool(
+            child_created,
+            2,
+            enumerate((b"job1\n", b"job2\n", b"job3\n", b"job4\n",
+                b"job5\n")),
+            popen=_MockPopen,
+            pipeline=2,
+            )
+        response = next(pool)
+        self.assertEqual(len(children), 2)
+        c0, c1 = children
+        self.assertEqual(c0.stdin_readline(), b'job1\n')
+        self.assertEqual(c1.stdin_readline(), b'job2\n')
+        self.assertEqual(c0.stdin_readline(), b'job3\n')
+        self.assertEqual(c1.stdin_readline(), b'job4\n')
+        self.assertEqual(response, ([2, 1], 0, b'AA\n'))
+        self.assertEqual(c0.stdin_readline(), b'job5\n')
+        self.assertEqual(next(pool), ([2, 3], 1, b'AA\n'))
+        c0.stdout_write(b'BB\nCC\n')
+        self.assertEqual(next(pool), ([4, 3], 2, b'BB\n'))
+        self.assertEqual(next(pool), ([None, 3], 4, b'CC\n'))
+        c1.stdout_write(b'DD\n')
+        self.assertEqual(next(pool), ([None, None], 3, b'DD\n'))
+        self.assertRaises(StopIteration, next, pool)
+        for c in children:
+            c.close_pipes()
+
+    def test_window(self):
+        children = []
+        def child_created(child):
+            # second child responds
+            if children:
+                child.stdout_write(b'BB\n')
+            children.append(child)
+        pool = worker_pool(
+            child_created,
+            3,
+            enumerate((b"job1\n", b"job2\n", b"job3\n", b"job4\n")),
+            popen=_MockPopen,
+            window=2,
+            )
+        response = next(pool)
+        # job3 is not started until job1 is finished
+        self.assertEqual(len(children), 2)
+        c0, c1 = children
+        self.assertEqual(c0.stdin_readline(), b'job1\n')
+        self.assertEqual(c1.stdin_readline(), b'job2\n')
+        self.assertEqual(response, ([0, None], 1, b'BB\n'))
+        c0.stdout_write(b'AA\n')
+        self.assertEqual(next(pool), ([2, 3], 0, b'AA\n'))
+        self.assertEqual(c0.stdin_readline(), b'job3\n')
+        self.assertEqual(c1.stdin_readline(), b'job4\n')
+        c1.stdout_write(b'DD\n')
+        self.assertEqual(next(pool), ([2, None], 3, b'DD\n'))
+        c0.stdout_write(b'CC\n')
+        self.assertEqual(next(pool), ([None, None], 2, b'CC\n'))
+        self.assertRaises(StopIteration, next, pool)
+        for c in children:
+            c.close_pipes()
+
+    def test_limiter(self):
+        children = []
+        def child_created(child):
+            child.stdout_write(b'AA\n')
+            children.append(child)
+        limiter = _FixedLimiter()
+        pool = worker_pool(
+            child_created,
+            2,
+            enumerate((b"job1\n", b"job2\n", b"job3\n", b"job4\n")),
+            popen=_MockPopen,
+            limiter=limiter,
+            )
+        response = next(pool)
+        # second worker not started while limit is 1
+        self.assertEqual(len(children), 1)
+        c0 = children[0]
+        self.assertEqual(c0.stdin_readline(), b'job1\n')
+        self.assertEqual(response, ([1], 0, b'AA\n'))
+        self.assertEqual(len(limiter.times), 1)
+        limiter.limit = 2
+        c0.stdout_write(b'BB\n')
+        self.assertEqual(next(pool), ([2, 3], 1, b'BB\n'))
+        self.assertEqual(len(children), 2)
+        self.assertEqual(next(pool), ([2, None], 3, b'AA\n'))
+        c0.stdout_write(b'CC\n')
+        self.assertEqual(list(pool), [([None, None], 2, b'CC\n')])
+        self.assertEqual(len(limiter.times), 4)
+        for c in children:
+            c.close_pipes()
+
+class _FixedLimiter(object):
+    limit = 1
+
+    def __init__(self):
+        self.times = []
+
+    def record(self, seconds):
+        self.times.append(seconds)
+
+
+class TestAdaptiveLimiter(unittest.TestCase):
+    def test_increase(self):
+        limiter = AdaptiveLimiter(12, initial=3)
+        for i in range(100):
+            limiter.record(0.1)
+        self.assertEqual(limiter.limit, 12)
+
+    def test_backoff(self):
+        limiter = AdaptiveLimiter(20, initial=10)
+        for i in range(10):
+            limiter.record(0.1)
+        self.assertEqual(limiter.limit, 11)
+        for i in range(11):
+            limiter.record(0.5)
+        self.assertEqual(limiter.limit, 7)
+
+    def test_throttled(self):
+        limiter = AdaptiveLimiter(20, initial=2, minimum=2)
+        limiter.throttled()
+        self.assertEqual(limiter.limit, 2)
+
+
+class _LimitedCKAN(object):
+    parallel_limit = 3
+
+
+class TestPoolOptions(unittest.TestCase):
+    def _args(self, **kwargs):
+        args = {'--processes': '8', '--threads': None, '--max-rps': None,
+            '--pipeline': '1', '--adaptive': False}
+        args.update(kwargs)
+        return args
+
+    def test_processes(self):
+        cmd, processes, kwargs = pool_options(_LimitedCKAN(),
+            self._args(**{'--max-rps': '5'}), ['cmd'], _upper_worker)
+        self.assertEqual((cmd, processes), (['cmd'], 3))
+        self.assertEqual(kwargs, {'max_rps': 5.0})
+
+    def test_threads(self):
+        cmd, processes, kwargs = pool_options(object(),
+            self._args(**{'--threads': '4', '--max-rps': '5',
+                '--pipeline': '2'}), ['cmd'], _upper_worker)
+        self.assertEqual((cmd, processes), (_upper_worker, 4))
+        self.assertEqual(kwargs, {'popen': ThreadWorker, 'pipeline': 2})
+
+    def test_adaptive(self):
+        cmd, processes, kwargs = pool_options(_LimitedCKAN(),
+            self._args(**{'--adaptive': True}), ['cmd'], _upper_worker)
+        self.assertEqual(processes, 8)
+        self.assertEqual(kwargs['limiter'].maximum, 8)
+        self.assertEqual(kwargs['limiter'].limit, 3)
+
+
+def _upper_worker(stdin, stdout):
+    for line in iter(stdin.readline, b''):
+        stdout.write(line.upper())
+        stdout.flush()
+
+
+def _framed_worker(stdin, stdout):
+    # payloads with newlines, sent in pieces
+    for line in iter(stdin.readline, b''):
+        data = frame([line.strip().decode('ascii')], line * 50000)
+        for i in range(0, len(data), 1000):
+            stdout.write(data[i:i + 1000])
+            stdout.flush()
+
+
+def _quitting_worker(stdin, stdout):
+    stdin.readline()
+
+
+class TestCLIThreadWorkers(unittest.TestCase):
+    def test_threads(self):
+        pool = worker_pool(
+            _upper_worker,
+            2,
+            enumerate((b"job1\n", b"job2\n", b"job3\n")),
+            popen=ThreadWorker,
+            )
+        results = sorted((finished, result) for _, finished, result in pool)
+        self.assertEqual(results, [
+            (0, b'JOB1\n'), (1, b'JOB2\n'), (2, b'JOB3\n')])
+
+    def test_many_workers(self):
+        pool = worker_pool(
+            _upper_worker,
+            50,
+            enumerate(b"job%d\n" % i for i in range(500)),
+            popen=ThreadWorker,
+            pipeline=3,
+            )
+        results = sorted((finished, result) for _, finished, result in pool)
+        self.assertEqual(results, [(i, b'JOB%d\n' % i) for i in range(500)])
+
+    def test_large_pipelined_jobs(self):
+        # jobs and results larger than pipe buffers must not deadlock
+        jobs = [b'x' * 200000 + b'%d\n' % i for i in range(4)]
+        pool = worker_pool(
+            _upper_worker,
+            1,
+            enumerate(jobs),
+            popen=ThreadWorker,
+            pipeline=4,
+            )
+        self.assertEqual([(f, r) for _, f, r in pool],
+            [(i, j.upper()) for i, j in enumerate(jobs)])
+
+    def test_max_rps(self):
+        pool = worker_pool(
+            _upper_worker,
+            2,
+            enumerate(b"job%d\n" % i for i in range(5)),
+            popen=ThreadWorker,
+            max_rps=50,
+            )
+        start = time.monotonic()
+        results = sorted((finished, result) for _, finished, result in pool)
+        self.assertTrue(time.monotonic() - start >= 0.075)
+        self.assertEqual(results, [(i, b'JOB%d\n' % i) for i in range(5)])
+
+    def test_thread_exit(self):
+        pool = worker_pool(
+            _quitting_worker,
+            1,
+            enumerate((b"job1\n",)),
+            popen=ThreadWorker,
+            )
+        self.assertEqual(next(pool), ([None], 0, b''))
+
+    def test_framed(self):
+        pool = worker_pool(
+            _framed_worker,
+            2,
+            enumerate(b"job%d\n" % i for i in range(6)),
+            popen=ThreadWorker,
+            pipeline=2,
+            framed=True,
+            )
+        results = sorted((finished, unframe(result))
+            for _, finished, result in pool)
+        self.assertEqual(results, [
+            (i, (['job%d' % i], b'job%d\n' % i * 50000)) for i in range(6)])
+
+    def test_framed_exit(self):
+        pool = worker_pool(
+            _quitting_worker,
+            1,
+            enumerate((b"job1\n",)),
+            popen=ThreadWorker,
+            framed=True,
+            )
+        self.assertEqual(next(pool), ([None], 0, b''))
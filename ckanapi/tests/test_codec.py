@@ -0,0 +1,70 @@
+from decimal import Decimal
+import json
+import unittest
+
+from ckanapi import codec
+
+
+class TestCodec(unittest.TestCase):
+    def setUp(self):
+        fallback = codec._StdlibCodec(json)
+        self.codecs = [fallback, codec._choose_codec('simplejson')]
+        if codec._orjson:
+            self.codecs.append(codec._OrjsonCodec(self.codecs[1]))
+
+    def test_dumps(self):
+        for c in self.codecs:
+            self.assertEqual(c.dumps({'b': [1, 'é'], 'a': None},
+                sort_keys=True), '{"a":null,"b":[1,"é"]}'.encode('utf-8'))
+
+    def test_dumps_pretty(self):
+        for c in self.codecs:
+            self.assertEqual(c.dumps_pretty({'b': {}, 'a': [1]}),
+                b'{\n  "a": [\n    1\n  ],\n  "b": {}\n}')
+
+    def test_loads(self):
+        for c in self.codecs:
+            self.assertEqual(c.loads(b'{"a":["\xc3\xa9",1.5]}'),
+                {'a': ['é', 1.5]})
+            self.assertEqual(c.loads('[true]'), [True])
+
+    def test_loads_big_int(self):
+        for c in self.codecs:
+            self.assertEqual(c.loads(b'[123456789012345678901234567890]'),
+                [123456789012345678901234567890])
+
+    def test_loads_nan(self):
+        for c in self.codecs:
+            self.assertEqual(repr(c.loads('NaN')), 'nan')
+
+    def test_loads_invalid(self):
+        for c in self.codecs:
+            self.assertRaises(ValueError, c.loads, b'{')
+
+    def test_dumps_fallback(self):
+        for c in self.codecs:
+            self.assertEqual(c.dumps({1: 2**70}), b'{"1":1180591620717411303424}')
+        for c in self.codecs[1:]:
+            self.assertEqual(c.dumps([Decimal('1.5')]), b'[1.5]')
+
+    def test_long_number_in_string(self):
+        self.assertFalse(codec._has_long_number(
+            b'{"hash":"1234567890123456789012"}'))
+        self.assertFalse(codec._has_long_number(
+            '{"a":"x\\"1234567890123456789012"}'))
+        self.assertTrue(codec._has_long_number(
+            b'{"a":"x","b":1234567890123456789012}'))
+        for c in self.codecs:
+            self.assertEqual(c.loads(b'["1234567890123456789012",1]'),
+                ['1234567890123456789012', 1])
+
+    def test_dumps_float_exponent(self):
+        values = [1e16, 1e-05, 1.5e300]
+        for c in self.codecs:
+            self.assertEqual(c.loads(c.dumps(values)), values)
+        self.assertEqual(self.codecs[0].dumps(values),
+            b'[1e+16,1e-05,1.5e+300]')
+        if codec._orjson:
+            # the only difference between backends, same values decoded
+            self.assertEqual(self.codecs[2].dumps(values),
+                b'[1e16,0.00001,1.5e300]')
@@ -1,11 +1,19 @@
 from ckanapi.datapackage import (
     dataset_to_datapackage, create_resource, create_datapackage,
-    resource_filename, populate_schema_from_datastore)
+    resource_filename, populate_schema_from_datastore, DownloadPool,
+    DownloadStore, create_datastore_csv)
+from ckanapi.common import iter_action
+from ckanapi.errors import CKANAPIError
 
+import hashlib
+import threading
+import time
 import unittest
+from unittest import mock
 from io import BytesIO
 import os
 from pyfakefs import fake_filesystem_unittest
+import requests
 
 
 class TestDatasetToDataPackage(unittest.TestCase):
@@ -199,6 +207,234 @@ class TestCreateResource(fake_filesystem_unittest.TestCase):
         }
 
 
+class _Download(object):
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        yield self.content
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class TestResumeResource(fake_filesystem_unittest.TestCase):
+    def setUp(self):
+        self.setUpPyfakefs()
+        os.makedirs('/test/data')
+        self.resource = {
+            'url': 'http://example.com/data.csv',
+            'size': 10,
+            'hash': hashlib.md5(b'0123456789').hexdigest(),
+            }
+
+    def _create(self, response):
+        stderr = BytesIO()
+        with mock.patch('ckanapi.datapackage.requests.get',
+                return_value=response) as get:
+            result = create_resource(self.resource, 'data.csv', '/test',
+                stderr, '')
+        return result, get, stderr.getvalue()
+
+    def test_resume(self):
+        with open('/test/data/data.csv.part', 'wb') as f:
+            f.write(b'01234')
+        with open('/test/data/data.csv.part.validator', 'w') as f:
+            f.write('"v1"')
+        result, get, err = self._create(_Download(206, b'56789'))
+        self.assertEqual(get.call_args[1]['headers']['Range'], 'bytes=5-')
+        self.assertEqual(get.call_args[1]['headers']['If-Range'], '"v1"')
+        self.assertFalse(os.path.exists('/test/data/data.csv.part.validator'))
+        self.assertEqual(result['path'], 'data/data.csv')
+        self.assertEqual(err, b'')
+        with open('/test/data/data.csv', 'rb') as f:
+            self.assertEqual(f.read(), b'0123456789')
+        self.assertFalse(os.path.exists('/test/data/data.csv.part'))
+
+    def test_range_ignored(self):
+        with open('/test/data/data.csv.part', 'wb') as f:
+            f.write(b'01234')
+        with open('/test/data/data.csv.part.validator', 'w') as f:
+            f.write('"v1"')
+        result, get, err = self._create(_Download(200, b'0123456789'))
+        with open('/test/data/data.csv', 'rb') as f:
+            self.assertEqual(f.read(), b'0123456789')
+
+    def test_no_validator_not_resumed(self):
+        del self.resource['size'], self.resource['hash']
+        with open('/test/data/data.csv.part', 'wb') as f:
+            f.write(b'old')
+        result, get, err = self._create(_Download(200, b'0123456789'))
+        self.assertNotIn('Range', get.call_args[1]['headers'])
+        with open('/test/data/data.csv', 'rb') as f:
+            self.assertEqual(f.read(), b'0123456789')
+
+    def test_validator_saved(self):
+        class _Interrupted(_Download):
+            def iter_content(self, chunk_size):
+                yield b'01234'
+                raise requests.ConnectionError()
+        self._create(_Interrupted(200, None,
+            {'ETag': 'W/"weak"', 'Last-Modified': 'Sat, 17 Oct 2026'}))
+        with open('/test/data/data.csv.part.validator') as f:
+            self.assertEqual(f.read(), 'Sat, 17 Oct 2026')
+        with open('/test/data/data.csv.part', 'rb') as f:
+            self.assertEqual(f.read(), b'01234')
+
+    def test_skip_matching(self):
+        with open('/test/data/data.csv', 'wb') as f:
+            f.write(b'0123456789')
+        result, get, err = self._create(None)
+        self.assertFalse(get.called)
+        self.assertEqual(result['path'], 'data/data.csv')
+
+    def test_replace_mismatch(self):
+        with open('/test/data/data.csv', 'wb') as f:
+            f.write(b'9876543210')
+        result, get, err = self._create(_Download(200, b'0123456789'))
+        self.assertNotIn('Range', get.call_args[1]['headers'])
+        self.assertEqual(err, b'')
+        with open('/test/data/data.csv', 'rb') as f:
+            self.assertEqual(f.read(), b'0123456789')
+
+    def test_hash_mismatch(self):
+        self.resource['hash'] = 'sha256:' + '0' * 64
+        result, get, err = self._create(_Download(200, b'0123456789'))
+        self.assertIn(b'hash does not match', err)
+
+
+class TestDownloadStore(fake_filesystem_unittest.TestCase):
+    def setUp(self):
+        self.setUpPyfakefs()
+        os.makedirs('/a/data')
+        os.makedirs('/b/data')
+        self.store = DownloadStore('/store')
+
+    def test_download_once(self):
+        resource = {'url': 'http://example.com/shared.csv'}
+        stderr = BytesIO()
+        with mock.patch('ckanapi.datapackage.requests.get',
+                return_value=_Download(200, b'a,b\n')) as get:
+            for d in ('/a', '/b'):
+                result = create_resource(resource, 'shared.csv', d,
+                    stderr, '', store=self.store)
+                self.assertEqual(result['path'], 'data/shared.csv')
+        self.assertEqual(get.call_count, 1)
+        for d in ('/a', '/b'):
+            with open(d + '/data/shared.csv', 'rb') as f:
+                self.assertEqual(f.read(), b'a,b\n')
+        self.assertEqual(os.stat('/a/data/shared.csv').st_ino,
+            os.stat('/b/data/shared.csv').st_ino)
+
+    def test_hash_mismatch_stored_by_url(self):
+        resource = {'url': 'http://example.com/changed.csv',
+            'hash': hashlib.sha1(b'old\n').hexdigest()}
+        stderr = BytesIO()
+        with mock.patch('ckanapi.datapackage.requests.get',
+                return_value=_Download(200, b'new\n')):
+            result = create_resource(resource, 'changed.csv', '/a',
+                stderr, '', store=self.store)
+        self.assertEqual(result['path'], 'data/changed.csv')
+        self.assertIn(b'does not match', stderr.getvalue())
+        key = self.store.key(resource)
+        self.assertFalse(os.path.exists(self.store._stored(key)))
+        self.assertNotIn(key, self.store._verified)
+        by_url = self.store._stored(self.store._url_key(resource))
+        with open(by_url, 'rb') as f:
+            self.assertEqual(f.read(), b'new\n')
+        self.assertEqual(os.stat(by_url).st_ino,
+            os.stat('/a/data/changed.csv').st_ino)
+
+    def test_key(self):
+        digest = hashlib.sha1(b'x').hexdigest()
+        self.assertEqual(self.store.key({'url': 'http://a', 'hash': digest}),
+            'sha1-' + digest)
+        self.assertEqual(self.store.key({'url': 'http://a', 'hash': ''}),
+            self.store.key({'url': 'http://a'}))
+
+
+class _DatastoreCKAN(object):
+    def __init__(self, records, sql=True):
+        self.records = records
+        self.sql = sql
+        self.calls = []
+
+    def iter_action(self, action, data_dict=None, requests_kwargs=None,
+            keyset=False):
+        return iter_action(self, action, data_dict, keyset=keyset,
+            prefetch=False)
+
+    def call_action(self, action, data_dict, requests_kwargs=None):
+        self.calls.append(action)
+        if action == 'datastore_search_sql':
+            if not self.sql:
+                raise CKANAPIError('not allowed')
+            sql = data_dict['sql'].split()
+            last_id = int(sql[sql.index('>') + 1])
+            limit = int(sql[sql.index('LIMIT') + 1])
+            return {'records': [r for r in self.records
+                if r['_id'] > last_id][:limit]}
+        start = data_dict.get('offset', 0)
+        return {
+            'fields': [{'id': '_id'}, {'id': 'a'}, {'id': 'b'}],
+            'records': self.records[start:start + data_dict['limit']],
+            }
+
+
+class TestDatastoreCSV(fake_filesystem_unittest.TestCase):
+    def setUp(self):
+        self.setUpPyfakefs()
+        os.makedirs('/test/data')
+        self.resource = {
+            'id': 'res1',
+            'datastore_fields': [{'id': '_id', 'type': 'int'},
+                {'id': 'a', 'type': 'text'}, {'id': 'b', 'type': 'json'}],
+            }
+        self.records = [
+            {'_id': 1, 'a': 'x', 'b': None},
+            {'_id': 2, 'a': 'y,z', 'b': [1, 2]},
+            {'_id': 3, 'a': 'é', 'b': 3},
+            ]
+
+    def _csv(self, ckan):
+        stderr = BytesIO()
+        result = create_datastore_csv(ckan, self.resource, 'res1.csv',
+            '/test', stderr)
+        self.assertEqual(stderr.getvalue(), b'')
+        self.assertEqual(result['path'], 'data/res1.csv')
+        with open('/test/data/res1.csv', encoding='utf-8', newline='') as f:
+            return f.read()
+
+    def test_keyset(self):
+        ckan = _DatastoreCKAN(self.records)
+        self.assertEqual(self._csv(ckan),
+            'a,b\r\nx,\r\n"y,z","[1,2]"\r\né,3\r\n')
+        self.assertIn('datastore_search_sql', ckan.calls)
+
+    def test_local_not_in_pool(self):
+        ckan = _DatastoreCKAN(self.records)
+        pool = mock.Mock()
+        dataset = {'name': 'ds', 'resources': [dict(self.resource,
+            name='res1', format='CSV', url='', datastore_active=True)]}
+        create_datapackage(dataset, '/test', BytesIO(), '',
+            download_pool=pool, ckan=ckan)
+        self.assertFalse(pool.submit.called)
+        self.assertTrue(os.path.exists('/test/ds/data/res1.csv'))
+
+    def test_sql_disabled(self):
+        ckan = _DatastoreCKAN(self.records, sql=False)
+        self.assertEqual(self._csv(ckan),
+            'a,b\r\nx,\r\n"y,z","[1,2]"\r\né,3\r\n')
+
+
 class TestCreateDataPackage(fake_filesystem_unittest.TestCase):
     def setUp(self):
         self.setUpPyfakefs()
@@ -306,3 +542,32 @@ class TestPopulateSchemaFromDatastore(unittest.TestCase):
                                     'type': 'string'}]
             }
         }
+
+
+class TestDownloadPool(unittest.TestCase):
+    def test_per_host_limit(self):
+        lock = threading.Lock()
+        active = {}
+        most = {}
+
+        def download(host, n):
+            with lock:
+                active[host] = active.get(host, 0) + 1
+                most[host] = max(most.get(host, 0), active[host])
+            time.sleep(0.01)
+            with lock:
+                active[host] -= 1
+            return n
+
+        with DownloadPool(max_workers=6, per_host=2) as pool:
+            futures = [
+                pool.submit('http://%s/f%d' % (host, n), download, host, n)
+                for n in range(6) for host in ('a.example', 'b.example')]
+        self.assertEqual([f.result() for f in futures],
+            [n for n in range(6) for host in 'ab'])
+        self.assertEqual(most, {'a.example': 2, 'b.example': 2})
+
+    def test_exception(self):
+        with DownloadPool() as pool:
+            future = pool.submit('http://a.example/', lambda: 1 / 0)
+        self.assertRaises(ZeroDivisionError, future.result)
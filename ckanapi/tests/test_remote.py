@@ -1,3 +1,4 @@
+import asyncio
 import subprocess
 import time
 import os
@@ -5,9 +6,14 @@ import atexit
 import socket
 import requests
 import json
+import tempfile
 
-from ckanapi import RemoteCKAN, NotFound
-from ckanapi.common import REQUEST_TIMEOUT
+import ckanapi
+
+from ckanapi import (RemoteCKAN, AsyncRemoteCKAN, RetryPolicy, NotFound,
+    ValidationError, MemoryCache, SQLiteCache)
+from ckanapi.common import (REQUEST_TIMEOUT, iter_action_result, iter_action,
+    TokenBucket)
 import unittest
 from unittest import mock
 from subprocess import DEVNULL
@@ -79,6 +85,25 @@ class TestRemoteAction(unittest.TestCase):
             self.assertEqual(ckan.action.test_echo_content_type(),
                 "application/json")
 
+    def test_compressed_request(self):
+        data_dict = {'notes': 'x' * 100}
+        with RemoteCKAN(TEST_CKAN, compress='gzip',
+                compress_min_size=50) as ckan:
+            res = ckan.call_action('test_echo_encoding', data_dict)
+        self.assertEqual(res['content_encoding'], 'gzip')
+        self.assertIn('gzip', res['accept_encoding'])
+        self.assertEqual(res['data_dict'], data_dict)
+
+    def test_small_request_not_compressed(self):
+        with RemoteCKAN(TEST_CKAN, compress='gzip') as ckan:
+            res = ckan.call_action('test_echo_encoding', {'name': 'a'})
+        self.assertEqual(res['content_encoding'], None)
+        self.assertEqual(res['data_dict'], {'name': 'a'})
+
+    def test_compress_unknown(self):
+        self.assertRaises(ckanapi.CKANAPIError,
+            RemoteCKAN, TEST_CKAN, compress='zip')
+
     def test_resource_upload(self):
         with RemoteCKAN(TEST_CKAN) as ckan:
             res = ckan.call_action('test_upload',
@@ -134,7 +159,393 @@ class TestRemoteAction(unittest.TestCase):
                 _, kwargs = mock_post.call_args
                 self.assertEqual(kwargs.get('timeout'), (2, 30))
 
+    def test_stream(self):
+        with RemoteCKAN(TEST_CKAN) as ckan:
+            result = ckan.call_action('organization_list', stream=True)
+            self.assertEqual(list(result), ['aa', 'bb', 'cc'])
+
+    def test_stream_key(self):
+        with RemoteCKAN(TEST_CKAN) as ckan:
+            result = ckan.call_action('datastore_search',
+                {'resource_id': 'x'}, stream='records')
+            self.assertEqual(next(result), {'_id': 1})
+            self.assertEqual(sum(1 for r in result), 999)
+
+    def test_stream_missing(self):
+        with RemoteCKAN(TEST_CKAN) as ckan:
+            result = ckan.call_action('organization_show', {'id': 'qqq'},
+                stream=True)
+            self.assertRaises(NotFound, list, result)
+
+    def test_async_good(self):
+        async def run():
+            async with AsyncRemoteCKAN(TEST_CKAN) as ckan:
+                return await ckan.action.organization_list()
+        self.assertEqual(asyncio.run(run()), ['aa', 'bb', 'cc'])
+
+    def test_async_gather(self):
+        async def run():
+            async with AsyncRemoteCKAN(TEST_CKAN, concurrency=4) as ckan:
+                return await asyncio.gather(*(
+                    ckan.call_action('organization_list')
+                    for i in range(10)))
+        self.assertEqual(asyncio.run(run()), [['aa', 'bb', 'cc']] * 10)
+
+    def test_async_missing(self):
+        async def run():
+            async with AsyncRemoteCKAN(TEST_CKAN) as ckan:
+                await ckan.action.organization_show(id='qqq')
+        self.assertRaises(NotFound, asyncio.run, run())
+
+    def test_async_parallel_limit(self):
+        with AsyncRemoteCKAN('http://example.com', concurrency=50) as ckan:
+            self.assertEqual(ckan.concurrency, ckan.parallel_limit)
+        with AsyncRemoteCKAN(TEST_CKAN, concurrency=50) as ckan:
+            self.assertEqual(ckan.concurrency, 50)
+
+    def test_call_actions(self):
+        with RemoteCKAN(TEST_CKAN) as ckan:
+            results = ckan.call_actions(
+                [('organization_list', {}), ('organization_show', {'id': 'q'})]
+                * 5)
+            self.assertEqual(len(results), 10)
+            self.assertEqual(results[0], ['aa', 'bb', 'cc'])
+            self.assertIsInstance(results[9], NotFound)
+            self.assertEqual(ckan.call_actions([]), [])
+
+    def test_async_call_actions(self):
+        async def run():
+            async with AsyncRemoteCKAN(TEST_CKAN) as ckan:
+                return await ckan.call_actions([
+                    ('organization_list', {}),
+                    ('organization_show', {'id': 'q'})])
+        results = asyncio.run(run())
+        self.assertEqual(results[0], ['aa', 'bb', 'cc'])
+        self.assertIsInstance(results[1], NotFound)
+
+    def test_iter_action(self):
+        with RemoteCKAN(TEST_CKAN) as ckan:
+            # mock server ignores limit and offset
+            self.assertEqual(list(ckan.iter_action('organization_list')),
+                ['aa', 'bb', 'cc'])
+
+    def test_async_iter_action(self):
+        async def run():
+            async with AsyncRemoteCKAN(TEST_CKAN) as ckan:
+                return [o async for o in ckan.iter_action(
+                    'organization_list')]
+        self.assertEqual(asyncio.run(run()), ['aa', 'bb', 'cc'])
+
     @classmethod
     def tearDownClass(cls):
         cls._mock_ckan.kill()
         cls._mock_ckan.wait()
+
+
+def _chunks(data, size=1):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+class TestIterActionResult(unittest.TestCase):
+    def test_list(self):
+        body = json.dumps({'help': 'x', 'success': True, 'result': [
+            1, 23456, -7.5e3, 'caf\u00e9 \u2603', None, True,
+            {'a': [1, {'b': '\\"]'}]}, [], {}]}, ensure_ascii=False)
+        for size in (1, 2, 7, 1000):
+            self.assertEqual(
+                list(iter_action_result('u', 200,
+                    _chunks(body.encode('utf-8'), size))),
+                json.loads(body)['result'])
+
+    def test_key(self):
+        body = (b'{"success": true, "result": {"fields": [{"id": "a"}], '
+            b'"records": [{"a": 1}, {"a": 2}], "total": 2}}')
+        self.assertEqual(
+            list(iter_action_result('u', 200, _chunks(body, 3), 'records')),
+            [{'a': 1}, {'a': 2}])
+
+    def test_empty(self):
+        self.assertEqual(list(iter_action_result('u', 200,
+            [b'{"success": true, "result": [ ]}'])), [])
+
+    def test_error(self):
+        body = (b'{"help": "x", "success": false, "error": {'
+            b'"__type": "Validation Error", "name": ["bad"]}}')
+        self.assertRaises(ValidationError, list,
+            iter_action_result('u', 409, _chunks(body, 4)))
+
+    def test_not_list(self):
+        self.assertRaises(ckanapi.CKANAPIError, list, iter_action_result(
+            'u', 200, [b'{"success": true, "result": {"a": 1}}']))
+
+    def test_invalid(self):
+        self.assertRaises(ckanapi.CKANAPIError, list, iter_action_result(
+            'u', 200, [b'{"success": true, "result": [1, 2']))
+
+
+class MockPagedCKAN(object):
+    def __init__(self, items):
+        self.items = items
+        self.calls = []
+
+    def call_action(self, name, data_dict, requests_kwargs=None):
+        self.calls.append((name, data_dict))
+        if name == 'package_search':
+            start, rows = data_dict['start'], data_dict['rows']
+            return {'count': len(self.items),
+                'results': self.items[start:start + rows]}
+        if name == 'datastore_search':
+            return {'fields': [{'id': '_id'}, {'id': 'a'}], 'records': []}
+        if name == 'datastore_search_sql':
+            last = int(data_dict['sql'].split('_id > ')[1].split()[0])
+            return {'records': [{'_id': i, 'a': i} for i in self.items
+                if i > last][:2]}
+        start, limit = data_dict['offset'], data_dict['limit']
+        return self.items[start:start + limit]
+
+
+class TestIterAction(unittest.TestCase):
+    def test_package_search(self):
+        ckan = MockPagedCKAN(list(range(5)))
+        self.assertEqual(list(iter_action(ckan, 'package_search',
+            {'q': 'x', 'rows': 2})), [0, 1, 2, 3, 4])
+        self.assertEqual(ckan.calls, [
+            ('package_search', {'q': 'x', 'rows': 2, 'start': 0}),
+            ('package_search', {'q': 'x', 'rows': 2, 'start': 2}),
+            ('package_search', {'q': 'x', 'rows': 2, 'start': 4})])
+
+    def test_list_ends_on_empty_page(self):
+        ckan = MockPagedCKAN(list(range(4)))
+        self.assertEqual(list(iter_action(ckan, 'user_list',
+            {'limit': 2}, prefetch=False)), [0, 1, 2, 3])
+        self.assertEqual([c[1]['offset'] for c in ckan.calls], [0, 2, 4])
+
+    def test_all_fields_page_size(self):
+        ckan = MockPagedCKAN(list(range(30)))
+        self.assertEqual(len(list(iter_action(ckan, 'organization_list',
+            {'all_fields': True}))), 30)
+        self.assertEqual(ckan.calls[0][1]['limit'], 25)
+
+    def test_keyset(self):
+        ckan = MockPagedCKAN([1, 2, 3, 5])
+        self.assertEqual(list(iter_action(ckan, 'datastore_search',
+            {'resource_id': 'r', 'limit': 2}, keyset=True)),
+            [{'_id': i, 'a': i} for i in [1, 2, 3, 5]])
+        self.assertEqual(ckan.calls[0],
+            ('datastore_search', {'resource_id': 'r', 'limit': 0}))
+        self.assertEqual(ckan.calls[2][1]['sql'],
+            'SELECT "_id", "a" FROM "r" WHERE _id > 2 ORDER BY _id LIMIT 2')
+
+    def test_keyset_filters(self):
+        ckan = MockPagedCKAN([])
+        self.assertRaises(ckanapi.CKANAPIError, iter_action(ckan,
+            'datastore_search', {'resource_id': 'r', 'q': 'x'},
+            keyset=True).__next__)
+
+    def test_unsupported(self):
+        self.assertRaises(ckanapi.CKANAPIError, iter_action(
+            MockPagedCKAN([]), 'package_show').__next__)
+
+
+class _Response(object):
+    def __init__(self, status_code, result=None, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = 'error'
+        if status_code == 200:
+            self.text = json.dumps({'success': True, 'result': result})
+        elif status_code == 409:
+            self.text = json.dumps({'success': False, 'error': dict(
+                result, __type='Validation Error')})
+
+    def close(self):
+        pass
+
+
+class _FlakySession(object):
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def post(self, url, **kwargs):
+        self.calls += 1
+        self.headers = kwargs.get('headers')
+        r = self.responses.pop(0)
+        if isinstance(r, Exception):
+            raise r
+        return r
+
+    def close(self):
+        pass
+
+
+@mock.patch('time.sleep')
+class TestRetry(unittest.TestCase):
+    def test_read_retried(self, sleep):
+        session = _FlakySession(
+            _Response(503, headers={'Retry-After': '7'}),
+            requests.exceptions.ConnectionError(),
+            _Response(200, 'ok'))
+        ckan = RemoteCKAN(TEST_CKAN, session=session, retry=RetryPolicy())
+        self.assertEqual(ckan.action.package_show(id='a'), 'ok')
+        self.assertEqual(session.calls, 3)
+        self.assertEqual(sleep.call_args_list[0], mock.call(7))
+        self.assertTrue(0 <= sleep.call_args_list[1][0][0] <= 1)
+
+    def test_retries_exhausted(self, sleep):
+        session = _FlakySession(*[_Response(502)] * 3)
+        ckan = RemoteCKAN(TEST_CKAN, session=session,
+            retry=RetryPolicy(retries=2))
+        self.assertRaises(ckanapi.CKANAPIError, ckan.action.package_list)
+        self.assertEqual(session.calls, 3)
+
+    def test_connection_error_exhausted(self, sleep):
+        session = _FlakySession(*[requests.exceptions.ConnectionError()] * 2)
+        ckan = RemoteCKAN(TEST_CKAN, session=session,
+            retry=RetryPolicy(retries=1))
+        self.assertRaises(requests.exceptions.ConnectionError,
+            ckan.action.package_list)
+
+    def test_write_not_retried(self, sleep):
+        session = _FlakySession(_Response(503), _Response(200, 'ok'))
+        ckan = RemoteCKAN(TEST_CKAN, session=session, retry=RetryPolicy())
+        self.assertRaises(ckanapi.CKANAPIError, ckan.action.package_create)
+        self.assertEqual(session.calls, 1)
+
+    def test_write_retried(self, sleep):
+        session = _FlakySession(_Response(429), _Response(200, 'ok'))
+        ckan = RemoteCKAN(TEST_CKAN, session=session,
+            retry=RetryPolicy(retry_writes=True))
+        self.assertEqual(ckan.action.package_create(), 'ok')
+
+    def test_error_not_retried(self, sleep):
+        session = _FlakySession(_Response(409, {'name': ['bad']}))
+        ckan = RemoteCKAN(TEST_CKAN, session=session, retry=RetryPolicy())
+        self.assertRaises(ValidationError, ckan.action.package_show)
+        self.assertEqual(session.calls, 1)
+
+    def test_delay(self, sleep):
+        retry = RetryPolicy(backoff=1, max_backoff=4)
+        for attempt in range(6):
+            self.assertTrue(0 <= retry.delay(attempt) <= min(4, 2 ** attempt))
+        self.assertEqual(retry.delay(0, '12'), 12)
+        self.assertEqual(retry.delay(0, 'Wed, 21 Oct 2015 07:28:00 GMT'), 0)
+        self.assertTrue(retry.delay(0, 'garbage') <= 1)
+
+
+class TestRateLimit(unittest.TestCase):
+    def test_token_bucket(self):
+        bucket = TokenBucket(10, burst=2)
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.assertTrue(0 < bucket.try_acquire() <= 0.1)
+
+    def test_rate_limit(self):
+        session = _FlakySession(*[_Response(200, 'ok')] * 5)
+        ckan = RemoteCKAN(TEST_CKAN, session=session, rate_limit=50)
+        start = time.monotonic()
+        for i in range(5):
+            ckan.action.package_show(id='a')
+        self.assertTrue(time.monotonic() - start >= 0.075)
+
+
+
+class TestConnectionPool(unittest.TestCase):
+    def _pool_kw(self, ckan):
+        adapter = ckan.open_session().get_adapter('https://demo.ckan.org')
+        return adapter.poolmanager.connection_pool_kw
+
+    def test_pool_maxsize(self):
+        kw = self._pool_kw(RemoteCKAN(TEST_CKAN, pool_maxsize=25))
+        self.assertEqual(kw['maxsize'], 25)
+
+    def test_keepalive(self):
+        kw = self._pool_kw(RemoteCKAN(TEST_CKAN, keepalive=30))
+        self.assertIn(
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1), kw['socket_options'])
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            self.assertIn((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30),
+                kw['socket_options'])
+
+    def test_keepalive_disabled(self):
+        kw = self._pool_kw(RemoteCKAN(TEST_CKAN, keepalive=None))
+        self.assertNotIn('socket_options', kw)
+
+    def test_async_concurrency(self):
+        ckan = AsyncRemoteCKAN(TEST_CKAN, concurrency=40)
+        self.assertEqual(self._pool_kw(ckan)['maxsize'], ckan.concurrency)
+
+    def test_shared_session(self):
+        from concurrent.futures import ThreadPoolExecutor
+        ckan = RemoteCKAN(TEST_CKAN)
+        with ThreadPoolExecutor(8) as executor:
+            sessions = list(executor.map(
+                lambda i: ckan.open_session(), range(8)))
+        self.assertEqual(len(set(map(id, sessions))), 1)
+        self.assertIs(sessions[0], ckan.session)
+
+class TestCache(unittest.TestCase):
+    def test_cached(self):
+        session = _FlakySession(_Response(200, {'name': 'a'}))
+        ckan = RemoteCKAN(TEST_CKAN, session=session, cache=MemoryCache())
+        self.assertEqual(ckan.action.package_show(id='a'), {'name': 'a'})
+        result = ckan.action.package_show(id='a')
+        self.assertEqual(result, {'name': 'a'})
+        self.assertEqual(session.calls, 1)
+        # results are not shared between calls
+        result['name'] = 'changed'
+        self.assertEqual(ckan.action.package_show(id='a'), {'name': 'a'})
+
+    def test_params(self):
+        session = _FlakySession(_Response(200, 'a'), _Response(200, 'b'))
+        ckan = RemoteCKAN(TEST_CKAN, session=session, cache=MemoryCache())
+        self.assertEqual(ckan.action.package_show(id='a'), 'a')
+        self.assertEqual(ckan.action.package_show(id='b'), 'b')
+
+    def test_write_bypass(self):
+        session = _FlakySession(_Response(200, 'a'), _Response(200, 'b'))
+        ckan = RemoteCKAN(TEST_CKAN, session=session, cache=MemoryCache())
+        self.assertEqual(ckan.action.package_patch(id='a'), 'a')
+        self.assertEqual(ckan.action.package_patch(id='a'), 'b')
+
+    def test_errors_not_cached(self):
+        session = _FlakySession(
+            _Response(409, {'id': ['bad']}), _Response(200, 'a'))
+        ckan = RemoteCKAN(TEST_CKAN, session=session, cache=MemoryCache())
+        self.assertRaises(ValidationError, ckan.action.package_show, id='a')
+        self.assertEqual(ckan.action.package_show(id='a'), 'a')
+
+    def test_revalidate(self):
+        session = _FlakySession(
+            _Response(200, 'a', headers={'ETag': '"v1"'}),
+            _Response(304))
+        ckan = RemoteCKAN(TEST_CKAN, session=session,
+            cache=MemoryCache(ttls={'package_show': 0}))
+        self.assertEqual(ckan.action.package_show(id='a'), 'a')
+        self.assertEqual(ckan.action.package_show(id='a'), 'a')
+        self.assertEqual(session.calls, 2)
+        self.assertEqual(session.headers['If-None-Match'], '"v1"')
+
+    def test_lru(self):
+        cache = MemoryCache(maxsize=2)
+        cache.set('a', {'v': 1})
+        cache.set('b', {'v': 2})
+        cache.get('a')
+        cache.set('c', {'v': 3})
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), {'v': 1})
+
+    def test_sqlite(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'cache.sqlite')
+            session = _FlakySession(_Response(200, 'a'))
+            cache = SQLiteCache(path)
+            ckan = RemoteCKAN(TEST_CKAN, session=session, cache=cache)
+            self.assertEqual(ckan.action.package_show(id='a'), 'a')
+            cache.close()
+            cache = SQLiteCache(path)
+            ckan = RemoteCKAN(TEST_CKAN, session=session, cache=cache)
+            self.assertEqual(ckan.action.package_show(id='a'), 'a')
+            self.assertEqual(session.calls, 1)
+            cache.close()